@@ -0,0 +1,593 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import threading
+import tracemalloc
+from VFMS_threaded import VirtualFileSystem, File, Directory, ChunkedContent, ByteContent, OutputWriter
+from VFMS_shard import ShardRouter
+from VFMS_pagecache import PageCache, POLICIES
+import VFMS_commands
+
+# Micro benchmarks for the virtual file system.
+#
+#   python VFMS_bench.py read_scaling [--threads 1 2 4 8] [--duration 1] [--exclusive]
+#   python VFMS_bench.py shard_scaling [--shards 1 2 4] [--sessions 8] [--ops 2000]
+#   python VFMS_bench.py workload [--names deep_tree ...] [--scale 100] [--output run.json] [--compare base.json]
+#   python VFMS_bench.py entry_memory [--entries 100000]
+#   python VFMS_bench.py stream_memory [--sizes 1 4 16 64]
+#   python VFMS_bench.py move_stress [--cycles 20] [--moves 2000] [--timeout 30]
+#   python VFMS_bench.py page_cache [--capacity 128] [--reads 50000] [--appends 50000]
+#
+# read_scaling times File.read_at itself. Under the GIL in-memory reads can't
+# run in parallel, so sharing the lock between readers doesn't add throughput
+# and the ReadWriteLock's bookkeeping makes each read about 30% slower than
+# with a plain exclusive lock; compare with --exclusive.
+
+
+class ExclusiveLock:
+    # File.lock stand-in that makes readers exclude each other, the behaviour
+    # before File moved to a ReadWriteLock, for comparison runs
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire_read(self):
+        self.lock.acquire()
+
+    def release_read(self):
+        self.lock.release()
+
+    acquire_write = acquire_read
+    release_write = release_read
+
+
+def hot_file(size):
+    vfs = VirtualFileSystem(num_blocks=size)
+    vfs.create_file('hot.txt')
+    file = vfs.root.get_file('hot.txt')
+    file.open('w')
+    vfs.write_to_file(file, 'x' * size)
+    file.close()
+    return file
+
+
+def read_scaling(thread_counts, duration, size, read_size, exclusive=False):
+    # read_at throughput on one shared file for each number of reader threads
+    file = hot_file(size)
+    if exclusive:
+        file.lock = ExclusiveLock()
+    results = []
+    for n in thread_counts:
+        counts = [0] * n
+        stop = threading.Event()
+        ready = threading.Barrier(n + 1)
+
+        def reader(i):
+            offset = (i * read_size) % size
+            ready.wait()
+            while not stop.is_set():
+                file.read_at(offset, read_size)
+                offset = (offset + read_size) % (size - read_size)
+                counts[i] += 1
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        ready.wait()
+        start = time.perf_counter()
+        time.sleep(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        results.append({'threads': n, 'reads': sum(counts), 'reads_per_sec': sum(counts) / elapsed})
+    return results
+
+
+def move_stress(cycles, moves, timeout):
+    # three threads moving files around a cycle of three directories, A <-> A/c,
+    # A/c <-> B and B <-> A, each pair taking both directory locks at once; a
+    # lock order that isn't total leaves them waiting on each other. Returns
+    # the moves each thread finished per cycle and whether any got stuck
+    vfs = VirtualFileSystem(num_blocks=64)
+    results = []
+    for cycle in range(cycles):
+        top = f"/cycle{cycle}"
+        vfs.create_directory(top[1:])
+        session = vfs.new_session()
+        vfs.change_directory(top, session)
+        # the directories reuse the memory of two freed placeholders, which
+        # mostly makes id(A/c) < id(B) < id(A): the layout where putting
+        # ancestors first and otherwise going by id() runs in a circle
+        low, high = Directory('low'), Directory('high')
+        vfs.create_directory('A', session)
+        del high
+        vfs.create_directory('B', session)
+        del low
+        vfs.change_directory('A', session)
+        vfs.create_directory('c', session)
+        pairs = [(f"{top}/A", f"{top}/A/c"), (f"{top}/A/c", f"{top}/B"), (f"{top}/B", f"{top}/A")]
+        counts = [0] * len(pairs)
+        ready = threading.Barrier(len(pairs))
+
+        def mover(i, here, there):
+            sessions = {}
+            for path in (here, there):
+                sessions[path] = vfs.new_session()
+                vfs.change_directory(path, sessions[path])
+            name = f"f{i}.txt"
+            vfs.create_file(name, sessions[here])
+            ready.wait()
+            for _ in range(moves):
+                vfs.move_file(name, there, sessions[here])
+                here, there = there, here
+                counts[i] += 1
+
+        threads = [threading.Thread(target=mover, args=(i, a, b), daemon=True) for i, (a, b) in enumerate(pairs)]
+        for t in threads:
+            t.start()
+        deadline = time.perf_counter() + timeout
+        for t in threads:
+            t.join(max(deadline - time.perf_counter(), 0))
+        stuck = any(t.is_alive() for t in threads)
+        results.append({'cycle': cycle, 'moves': list(counts), 'stuck': stuck})
+        if stuck:
+            break
+    return results
+
+
+def shard_scaling(shard_counts, sessions, ops, size):
+    # command throughput of concurrent sessions, each in its own top-level
+    # directory, against a ShardRouter with each number of shards
+    results = []
+    for n in shard_counts:
+        router = ShardRouter(n, num_blocks=sessions * size)
+        ready = threading.Barrier(sessions + 1)
+
+        def client(i):
+            session = router.new_session()
+            for line in (f"mkdir s{i}", f"chdir s{i}", "create f", "open f w", f"write_to_file f {'x' * size}", "close f"):
+                router.execute(session, VFMS_commands.parse(line))
+            work = [VFMS_commands.parse(line) for line in (f"read_from_file f 0 {size}", "ls")]
+            ready.wait()
+            for k in range(ops):
+                router.execute(session, work[k % 2])
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(sessions)]
+        for t in threads:
+            t.start()
+        ready.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        router.close()
+        results.append({'shards': n, 'commands': sessions * ops, 'commands_per_sec': sessions * ops / elapsed})
+    return results
+
+
+# Synthetic workloads. Each one builds a VirtualFileSystem and returns it with
+# one generator per concurrent session. A generator yields (operation, function,
+# args) steps; the harness times every step on its own, so whatever a generator
+# does between yields (picking names, building data) isn't measured.
+
+def deep_tree(scale, sessions, rng):
+    # a chain of scale nested directories, then jumps and moves between depths
+    vfs = VirtualFileSystem(num_blocks=scale * 64)
+
+    def steps():
+        session = vfs.new_session()
+        paths = []
+        for i in range(scale):
+            yield 'create_directory', vfs.create_directory, (f"d{i}", session)
+            yield 'change_directory', vfs.change_directory, (f"d{i}", session)
+            paths.append(session.current_directory.path())
+        vfs.create_file('leaf.txt', session)
+        here = paths[-1]
+        for _ in range(scale * 10):
+            yield 'change_directory', vfs.change_directory, (rng.choice(paths), session)
+        vfs.change_directory(here, session)
+        for _ in range(scale * 10):
+            there = rng.choice(paths)
+            if there == here:
+                continue
+            yield 'move_file', vfs.move_file, ('leaf.txt', there, session)
+            vfs.change_directory(there, session)
+            here = there
+    return vfs, [steps()]
+
+
+def small_files(scale, sessions, rng):
+    # scale * 10 tiny files spread over ten directories: create, fill, read, delete
+    vfs = VirtualFileSystem(num_blocks=scale * 10 * 64)
+
+    def steps():
+        session = vfs.new_session()
+        for d in range(10):
+            vfs.create_directory(f"dir{d}", session)
+        names = [(f"/dir{i % 10}", f"f{i}.txt") for i in range(scale * 10)]
+        for where, name in names:
+            vfs.change_directory(where, session)
+            yield 'create_file', vfs.create_file, (name, session)
+            _file = session.current_directory.get_file(name)
+            _file.open('w')
+            yield 'write', vfs.write_to_file, (_file, 'x' * rng.randint(1, 64))
+            _file.close()
+        rng.shuffle(names)
+        for where, name in names:
+            vfs.change_directory(where, session)
+            yield 'read', session.current_directory.get_file(name).read, ()
+        for where, name in names:
+            vfs.change_directory(where, session)
+            yield 'delete_file', vfs.delete_file, (name, session)
+    return vfs, [steps()]
+
+
+def append_stream(scale, sessions, rng):
+    # one file growing by small appends and inserts, then cut back down
+    vfs = VirtualFileSystem(num_blocks=scale * 100 * 64 * 2)
+    vfs.create_file('stream.log')
+    _file = vfs.root.get_file('stream.log')
+
+    def steps():
+        _file.open('w')
+        for _ in range(scale * 50):
+            yield 'write', vfs.write_to_file, (_file, 'y' * 64)
+        for _ in range(scale * 50):
+            yield 'write_at', vfs.write_to_file, (_file, 'z' * 16, rng.randint(0, _file.size))
+        _file.close()
+        for _ in range(scale):
+            yield 'truncate', vfs.truncate_file, (_file, rng.randint(0, _file.size))
+        # update_mmap on its own: grow the content, then map the difference
+        _file.open('w')
+        for _ in range(scale * 10):
+            _file.write('w' * 256)
+            yield 'update_mmap', vfs.update_mmap, (_file,)
+        _file.close()
+    return vfs, [steps()]
+
+
+def hot_read(scale, sessions, rng):
+    # every session hammers read_at on one shared file
+    size = scale * 1024
+    vfs = VirtualFileSystem(num_blocks=size)
+    vfs.create_file('hot.txt')
+    _file = vfs.root.get_file('hot.txt')
+    _file.open('w')
+    vfs.write_to_file(_file, 'h' * size)
+    _file.close()
+
+    def steps(seed):
+        local = random.Random(seed)
+        for _ in range(scale * 50):
+            yield 'read_at', _file.read_at, (local.randrange(size - 256), 256)
+    return vfs, [steps(rng.random()) for _ in range(sessions)]
+
+
+def concurrent_sessions(scale, sessions, rng):
+    # N sessions each running a mixed command script through the command table,
+    # in their own directory plus moves into a shared one
+    vfs = VirtualFileSystem(num_blocks=sessions * scale * 256)
+    vfs.create_directory('shared')
+
+    def steps(n, seed):
+        local = random.Random(seed)
+        session = vfs.new_session()
+        run = VFMS_commands.execute
+        for line in (f"mkdir s{n}", f"chdir s{n}"):
+            run(vfs, session, VFMS_commands.parse(line))
+        for i in range(scale):
+            name = f"f{i}.txt"
+            script = [f"create {name}", f"open {name} w", f"write_to_file {name} {'q' * local.randint(1, 128)}",
+                      f"close {name}", f"read_from_file {name} 0 8", "ls"]
+            if local.random() < 0.2:
+                script.append(f"move {name} /shared")
+            for line in script:
+                invocation = VFMS_commands.parse(line)
+                yield invocation[0].name, run, (vfs, session, invocation)
+    return vfs, [steps(n, rng.random()) for n in range(sessions)]
+
+
+WORKLOADS = {
+    'deep_tree': deep_tree,
+    'small_files': small_files,
+    'append_stream': append_stream,
+    'hot_read': hot_read,
+    'sessions': concurrent_sessions,
+}
+
+
+def drive(generator, latencies, peaks=None):
+    # run one session's steps, timing each, or tracing its allocations when
+    # peaks is given
+    for op, function, args in generator:
+        if peaks is None:
+            start = time.perf_counter()
+            function(*args)
+            latencies.setdefault(op, []).append(time.perf_counter() - start)
+        else:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function(*args)
+            peaks[op] = max(peaks.get(op, 0), tracemalloc.get_traced_memory()[1] - before)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_workload(name, scale, sessions, seed):
+    # one timed pass with sessions in parallel threads, then a traced pass with
+    # the same seed, run one session at a time, for the memory figures
+    vfs, generators = WORKLOADS[name](scale, sessions, random.Random(seed))
+    latencies = [{} for _ in generators]
+    threads = [threading.Thread(target=drive, args=(g, l)) for g, l in zip(generators, latencies)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    peaks = {}
+    tracemalloc.start()
+    try:
+        vfs, generators = WORKLOADS[name](scale, sessions, random.Random(seed))
+        for generator in generators:
+            drive(generator, None, peaks)
+    finally:
+        tracemalloc.stop()
+
+    merged = {}
+    for per_session in latencies:
+        for op, values in per_session.items():
+            merged.setdefault(op, []).extend(values)
+    ops = {}
+    for op, values in merged.items():
+        values.sort()
+        ops[op] = {'count': len(values), 'ops_per_sec': len(values) / sum(values) if sum(values) else 0.0,
+                   'p50_us': percentile(values, 0.5) * 1e6, 'p99_us': percentile(values, 0.99) * 1e6,
+                   'peak_bytes': peaks.get(op, 0)}
+    total = sum(op['count'] for op in ops.values())
+    return {'wall_sec': wall, 'ops_per_sec': total / wall, 'ops': ops}
+
+
+def compare(old, new, threshold):
+    # lines describing per operation changes between two result files; an op
+    # whose p50 grew by more than threshold is a regression (ops/s follows the
+    # mean, which scheduling noise in the tail moves too much to judge by)
+    lines = []
+    for workload, result in new['results'].items():
+        before = old['results'].get(workload)
+        if before is None:
+            continue
+        for op, stats in result['ops'].items():
+            base = before['ops'].get(op)
+            if base is None or not base['p50_us'] or not base['ops_per_sec']:
+                continue
+            latency = stats['p50_us'] / base['p50_us'] - 1
+            throughput = stats['ops_per_sec'] / base['ops_per_sec'] - 1
+            flag = '  REGRESSION' if latency > threshold else ''
+            lines.append(f"{workload:14} {op:18} p50 {latency:+7.1%}  ops/s {throughput:+7.1%}{flag}")
+    return lines
+
+
+def entry_memory(entries):
+    # bytes per empty directory and per empty file, counting everything the
+    # entry brings with it (object, parent's contents slot, index entries) but
+    # not the name string itself
+    vfs = VirtualFileSystem()
+    fanout = 1000
+    results = {}
+    for kind, create in (('directory', vfs.create_directory), ('file', vfs.create_file)):
+        session = vfs.new_session()
+        vfs.create_directory(kind)
+        vfs.change_directory(kind, session)
+        names = [f"{kind[0]}{i:07d}" + ('.txt' if kind == 'file' else '') for i in range(entries)]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(0, entries, fanout):
+            # keep directories to a realistic size so dict growth isn't all
+            # the memory being measured
+            vfs.create_directory(f"g{i}", session)
+            vfs.change_directory(f"g{i}", session)
+            for name in names[i:i + fanout]:
+                create(name, session)
+            vfs.change_directory('..', session)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del names
+        results[kind] = used / entries
+    return results
+
+
+def stream_memory(sizes):
+    # peak memory of sending a whole file to a session's output, built as one
+    # string by read() and streamed by read_from_file, for each storage
+    results = []
+    for storage, content_class in (('str', ChunkedContent), ('bytes', ByteContent)):
+        File.content_class = content_class
+        try:
+            for mb in sizes:
+                size = mb * 1024 * 1024
+                vfs = VirtualFileSystem(num_blocks=1024, block_size=-(-size // 1024))
+                vfs.create_file('big.txt')
+                _file = vfs.root.get_file('big.txt')
+                _file.open('w')
+                piece = 'x' * (1024 * 1024)
+                for _ in range(mb):
+                    vfs.write_to_file(_file, piece)
+                _file.close()
+                session = vfs.new_session()
+                read = VFMS_commands.parse('read_from_file big.txt')
+                row = {'storage': storage, 'size_mb': mb}
+                for way, produce in (('read', _file.read), ('stream', lambda: VFMS_commands.execute(vfs, session, read))):
+                    out = OutputWriter(os.devnull, 'exit')
+                    tracemalloc.start()
+                    out.write(produce())
+                    out.flush()
+                    row[way + '_peak'] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    out.close()
+                results.append(row)
+        finally:
+            File.content_class = ChunkedContent
+    return results
+
+
+def page_patterns(pages, capacity, reads, rng):
+    # page numbers read under each access pattern, out of pages in all
+    hot = list(range(capacity // 4))
+    scan = iter(range(10 ** 9))
+    return {
+        # most reads on a small hot set, the rest anywhere
+        'hot_set': [rng.choice(hot) if rng.random() < 0.9 else rng.randrange(pages) for _ in range(reads)],
+        # a hot set read alongside sequential scans through everything
+        'scan': [rng.choice(hot) if rng.random() < 0.7 else next(scan) % pages for _ in range(reads)],
+        # a loop over slightly more pages than fit
+        'loop': [i % (capacity + capacity // 4) for i in range(reads)],
+    }
+
+
+def page_cache(capacity, reads, appends, seed=1):
+    # hit rate and speed of each eviction policy under each access pattern,
+    # and appends through the cache against straight to the file
+    rng = random.Random(seed)
+    page_size = 4096
+    files, per_file = 8, capacity // 2
+    vfs = VirtualFileSystem(num_blocks=files * per_file + 1, block_size=page_size)
+    for i in range(files):
+        vfs.create_file(f"f{i}.txt")
+        _file = vfs.root.get_file(f"f{i}.txt")
+        _file.open('w')
+        vfs.write_to_file(_file, 'x' * (page_size * per_file))
+        _file.close()
+    handles = [vfs.root.get_file(f"f{i}.txt") for i in range(files)]
+    rows = []
+    for pattern, sequence in page_patterns(files * per_file, capacity, reads, rng).items():
+        for policy in POLICIES:
+            vfs.page_cache = PageCache(vfs, capacity, policy, page_size)
+            start = time.perf_counter()
+            for page in sequence:
+                _file = handles[page % files]
+                vfs.read_at(_file, (page // files) * page_size + 100, 256)
+            elapsed = time.perf_counter() - start
+            stats = vfs.page_cache.stats()['policies'][policy]
+            rows.append({'pattern': pattern, 'policy': policy, 'hit_rate': stats['hit_rate'],
+                         'reads_per_sec': len(sequence) / elapsed})
+    appended = {}
+    for way in ('direct', 'cached'):
+        vfs = VirtualFileSystem(num_blocks=appends * 8 // page_size + 2, block_size=page_size)
+        if way == 'cached':
+            vfs.page_cache = PageCache(vfs, capacity, 'lru', page_size)
+        vfs.create_file('log.txt')
+        _file = vfs.root.get_file('log.txt')
+        _file.open('w')
+        start = time.perf_counter()
+        for i in range(appends):
+            vfs.write_to_file(_file, 'entry%03d' % (i % 1000))
+        vfs.sync()
+        appended[way] = appends / (time.perf_counter() - start)
+    return rows, appended
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="VFMS benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+    rs = sub.add_parser('read_scaling', help="concurrent read_at throughput on one hot file")
+    rs.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    rs.add_argument('--duration', type=float, default=1.0)
+    rs.add_argument('--size', type=int, default=1 << 20)
+    rs.add_argument('--read-size', type=int, default=4096)
+    rs.add_argument('--exclusive', action='store_true', help="make readers exclude each other for comparison")
+    ss = sub.add_parser('shard_scaling', help="command throughput across shard processes")
+    ss.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    ss.add_argument('--sessions', type=int, default=8)
+    ss.add_argument('--ops', type=int, default=2000, help="commands per session")
+    ss.add_argument('--size', type=int, default=64 * 1024, help="bytes each session writes and then reads back")
+    wl = sub.add_parser('workload', help="synthetic workloads timing every VFS operation")
+    wl.add_argument('--names', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS))
+    wl.add_argument('--scale', type=int, default=100, help="size of each workload")
+    wl.add_argument('--sessions', type=int, default=8, help="concurrent sessions for hot_read and sessions")
+    wl.add_argument('--seed', type=int, default=1)
+    wl.add_argument('--output', help="save results to this JSON file")
+    wl.add_argument('--compare', help="JSON file from an earlier run to compare against")
+    wl.add_argument('--threshold', type=float, default=0.10, help="relative change reported as a regression")
+    em = sub.add_parser('entry_memory', help="bytes of metadata per directory and file")
+    em.add_argument('--entries', type=int, default=100000)
+    sm = sub.add_parser('stream_memory', help="peak memory of reading a whole file, built versus streamed")
+    sm.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16, 64], help="file sizes in MiB")
+    ms = sub.add_parser('move_stress', help="concurrent moves around cycles of directories, failing on a deadlock")
+    ms.add_argument('--cycles', type=int, default=20, help="directory cycles to run, one after another")
+    ms.add_argument('--moves', type=int, default=2000, help="moves per thread and cycle")
+    ms.add_argument('--timeout', type=float, default=30.0, help="seconds a cycle may take before it counts as stuck")
+    pc = sub.add_parser('page_cache', help="page cache hit rate per eviction policy and append throughput")
+    pc.add_argument('--capacity', type=int, default=128, help="pages the cache holds")
+    pc.add_argument('--reads', type=int, default=50000, help="page reads per pattern")
+    pc.add_argument('--appends', type=int, default=50000, help="small appends to one file")
+    args = parser.parse_args(argv)
+
+    if args.bench == 'read_scaling':
+        print(f"{'threads':>8} {'reads/s':>12} {'speedup':>8}")
+        results = read_scaling(args.threads, args.duration, args.size, args.read_size, args.exclusive)
+        base = results[0]['reads_per_sec']
+        for r in results:
+            print(f"{r['threads']:>8} {r['reads_per_sec']:>12.0f} {r['reads_per_sec'] / base:>8.2f}")
+    elif args.bench == 'shard_scaling':
+        print(f"{'shards':>8} {'commands/s':>12} {'speedup':>8}")
+        results = shard_scaling(args.shards, args.sessions, args.ops, args.size)
+        base = results[0]['commands_per_sec']
+        for r in results:
+            print(f"{r['shards']:>8} {r['commands_per_sec']:>12.0f} {r['commands_per_sec'] / base:>8.2f}")
+    elif args.bench == 'entry_memory':
+        results = entry_memory(args.entries)
+        over = False
+        for kind, cls in (('directory', Directory), ('file', File)):
+            used = results[kind]
+            over = over or used > cls.MEMORY_BUDGET
+            print(f"{kind:10} {used:8.0f} bytes per entry (budget {cls.MEMORY_BUDGET})")
+        if over:
+            sys.exit(1)
+    elif args.bench == 'stream_memory':
+        print(f"{'storage':8} {'size(MiB)':>9} {'read peak(B)':>13} {'stream peak(B)':>15}")
+        for r in stream_memory(args.sizes):
+            print(f"{r['storage']:8} {r['size_mb']:>9} {r['read_peak']:>13} {r['stream_peak']:>15}")
+    elif args.bench == 'move_stress':
+        results = move_stress(args.cycles, args.moves, args.timeout)
+        for r in results:
+            print(f"cycle {r['cycle']:>3}: moves per thread {r['moves']}{' STUCK' if r['stuck'] else ''}")
+        if results[-1]['stuck']:
+            sys.exit(1)
+    elif args.bench == 'page_cache':
+        rows, appended = page_cache(args.capacity, args.reads, args.appends)
+        print(f"{'pattern':8} {'policy':6} {'hit rate':>8} {'reads/s':>10}")
+        for r in rows:
+            print(f"{r['pattern']:8} {r['policy']:6} {r['hit_rate']:>8.1%} {r['reads_per_sec']:>10.0f}")
+        print(f"appends/s direct {appended['direct']:.0f}, through the cache {appended['cached']:.0f}")
+    elif args.bench == 'workload':
+        run = {'meta': {'python': platform.python_version(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'scale': args.scale, 'sessions': args.sessions, 'seed': args.seed},
+               'results': {}}
+        print(f"{'workload':14} {'operation':18} {'count':>7} {'ops/s':>10} {'p50(us)':>9} {'p99(us)':>9} {'peak(B)':>9}")
+        for name in args.names:
+            result = run['results'][name] = run_workload(name, args.scale, args.sessions, args.seed)
+            for op, stats in result['ops'].items():
+                print(f"{name:14} {op:18} {stats['count']:>7} {stats['ops_per_sec']:>10.0f} "
+                      f"{stats['p50_us']:>9.1f} {stats['p99_us']:>9.1f} {stats['peak_bytes']:>9}")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(run, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                lines = compare(json.load(f), run, args.threshold)
+            print()
+            print('\n'.join(lines))
+            if any(line.endswith('REGRESSION') for line in lines):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,289 @@
+# Command table shared by the VFMS front ends. Every command is registered
+# with its argument spec and a handler taking (vfs, session, *args) that
+# returns the text to show. Scripts are parsed once into (command, args) pairs
+# which can then be executed straight against the VirtualFileSystem.
+
+import json
+import datetime
+import VFMS_stats
+
+COMMANDS = {}
+# read_from_file hands files at least this large back as a stream of pieces of
+# STREAM_CHUNK instead of one string, see File.read_stream
+STREAM_THRESHOLD = 1 << 20
+STREAM_CHUNK = 64 * 1024
+
+
+class Command:
+    def __init__(self, name, handler, usage, help, counts=None, types=(), ends_session=False):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        # help may span several lines, the first one sits next to the usage
+        self.help = help if isinstance(help, list) else [help]
+        # allowed argument counts (None for any) and a converter per position
+        self.counts = counts
+        self.types = types
+        self.ends_session = ends_session
+
+    def bind(self, args):
+        # converted arguments, or None when they don't fit the spec
+        if self.counts is not None and len(args) not in self.counts:
+            return None
+        try:
+            return [convert(arg) for convert, arg in zip(self.types, args)] + args[len(self.types):]
+        except ValueError:
+            return None
+
+
+def command(name, usage, help, counts=None, types=(), ends_session=False):
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, usage, help, counts, types, ends_session)
+        return handler
+    return register
+
+
+def parse(line):
+    # (command, args) ready to execute, (None, message) for a line that can't
+    # run, or None for a blank line
+    parts = line.split()
+    if not parts:
+        return None
+    cmd = COMMANDS.get(parts[0])
+    if cmd is None:
+        return None, f"\nUnknown command: {parts[0]}"
+    args = cmd.bind(parts[1:])
+    if args is None:
+        return None, f"Usage: {cmd.usage}"
+    return cmd, args
+
+
+def parse_script(lines):
+    parsed = []
+    for line in lines:
+        invocation = parse(line)
+        if invocation is not None:
+            parsed.append(invocation)
+    return parsed
+
+
+def internal_error(error):
+    # output standing in for that of a command that raised instead
+    return f"\nInternal error: {type(error).__name__}: {error}"
+
+
+def execute(vfs, session, invocation):
+    cmd, args = invocation
+    if cmd is None:
+        return args
+    return cmd.handler(vfs, session, *args)
+
+
+def timestamp(ns):
+    # entries keep integer nanoseconds; only a listing turns them into text
+    return datetime.datetime.fromtimestamp(ns // 1000000000).strftime('%Y-%m-%d %H:%M:%S')
+
+
+@command("ls", "ls", "List contents of current directory")
+def ls(vfs, session, *args):
+    # sizes include appends the page cache holds back, without flushing them
+    out = [f"\n{'name':15} {'type':10} {'size':10} {'mode':10} {'last_modified':19}"]
+    for item in session.current_directory.contents.values():
+        if str(item)[:4] == "File":
+            out.append(f"\n{str(item.name):15} {str(item.type):10} {str(vfs.size_of(item))+'B':10} {str(item.open_mode):10} {timestamp(item.modified_at)}")
+        else:
+            out.append(f"\n{str(item.name):15} {'dir':10} {'-':10} {'-':10} {timestamp(item.modified_at)}")
+    return ''.join(out)
+
+
+@command("mkdir", "mkdir <name>", "Create new directory in current directory", counts=(1,))
+def mkdir(vfs, session, name):
+    return vfs.create_directory(name, session)
+
+
+@command("rmdir", "rmdir <name>", "Remove directory from current directory", counts=(1,))
+def rmdir(vfs, session, name):
+    return vfs.delete_directory(name, session)
+
+
+@command("chdir", "chdir <path>", ["Change current directory. Set path as:",
+                                   "..      ==>     Move up directory",
+                                   "/       ==>     Return to root",
+                                   "/d/d    ==>     Absolute path",
+                                   "d/d     ==>     Relative path"], counts=(1,))
+def chdir(vfs, session, path):
+    return vfs.change_directory(path, session)
+
+
+@command("create", "create <name>", "Create new file in current directory", counts=(1,))
+def create(vfs, session, name):
+    return vfs.create_file(name, session)
+
+
+@command("delete", "delete <name>", "Remove file from current directory", counts=(1,))
+def delete(vfs, session, name):
+    return vfs.delete_file(name, session)
+
+
+@command("move", "move <f_name> <path>", "Move file to another directory", counts=(2,))
+def move(vfs, session, name, path):
+    return vfs.move_file(name, path, session)
+
+
+@command("open", "open <name> <mode>", "Open file in r or w mode", counts=(2,))
+def open_(vfs, session, name, mode):
+    if mode not in ("w", "r"):
+        return "Enter a valid mode to open file (r,w)"
+    return vfs.open_file(name, mode, session)
+
+
+@command("close", "close <name>", "Close file", counts=(1,))
+def close(vfs, session, name):
+    return vfs.close_file(name, session)
+
+
+@command("write_to_file", "write_to_file <name> <data> <offset>", "Write to file at a specific offset (optional)",
+         counts=(2, 3), types=(str, str, int))
+def write_to_file(vfs, session, name, data, offset=None):
+    # with dedup the data may need no new blocks at all, so it is let through
+    # and mapped as far as the device allows
+    if vfs.dedup is None and vfs.calc_free_memory() < len(data):
+        return "Cannot write to file as memory is full"
+    file = session.current_directory.get_file(name)
+    if not file:
+        return f"\nNo such file: {name}"
+    return vfs.write_to_file(file, data, offset)
+
+
+@command("read_from_file", "read_from_file <name> <offset> <length>", "Read from file from a specific offset (optional)",
+         counts=(1, 3), types=(str, int, int))
+def read_from_file(vfs, session, name, offset=None, length=None):
+    file = session.current_directory.get_file(name)
+    if not file:
+        return f"\nNo such file: {name}"
+    if offset is None:
+        vfs.settle(file)
+        if file.size >= STREAM_THRESHOLD:
+            return file.read_stream(STREAM_CHUNK)
+        return file.read()
+    data = vfs.read_at(file, offset, length)
+    return data if isinstance(data, str) else str(data, 'utf-8', 'replace')
+
+
+@command("truncate", "truncate <name> <size>", "Truncate file to a specified size (or all of it if not specified)",
+         counts=(1, 2), types=(str, int))
+def truncate(vfs, session, name, size=0):
+    file = session.current_directory.get_file(name)
+    if not file:
+        return f"\nNo such file: {name}"
+    return vfs.truncate_file(file, size)
+
+
+@command("show_memory_map", "show_memory_map", "Display Memory Map")
+def show_memory_map(vfs, session, *args):
+    # appends the page cache holds back get their blocks once flushed
+    out = ["\n\n"]
+    for block in range(len(vfs.memory)):
+        cell = vfs.map_cell(block)
+        out.append("*\t" if cell is None else str(cell)+"\t")
+        if (block + 1) % vfs.MAP_WIDTH == 0:
+            out.append("\n")
+    if vfs.dedup is not None:
+        out.append(vfs.dedup.report())
+    return ''.join(out)
+
+
+@command("import_host", "import_host <host_dir> <vfs_path>", "Copy the contents of a host directory into a directory",
+         counts=(2,))
+def import_host(vfs, session, host_dir, path):
+    return vfs.import_host(host_dir, path, session)
+
+
+@command("export_host", "export_host <vfs_path> <host_dir>", "Copy the contents of a directory out to a host directory",
+         counts=(2,))
+def export_host(vfs, session, path, host_dir):
+    return vfs.export_host(path, host_dir, session)
+
+
+# reply of find when nothing matches, also used to merge sharded results
+NO_MATCHES = "\nNo matches found"
+
+
+@command("find", "find <pattern> | -type <ext>", "Find files and directories by name (* ? [] wildcards) or files by type",
+         counts=(1, 2))
+def find(vfs, session, *args):
+    if len(args) == 2:
+        if args[0] != "-type":
+            return "Usage: find <pattern> | -type <ext>"
+        found = vfs.index.find_type(args[1].lstrip('.'))
+    else:
+        found = vfs.index.find(args[0])
+    if not found:
+        return NO_MATCHES
+    return ''.join(sorted("\n" + item.path() for item in found))
+
+
+@command("grep", "grep <text> <path>", "List files containing text, below path (optional) or the current directory",
+         counts=(1, 2))
+def grep(vfs, session, text, path=None):
+    found = vfs.grep(text, path, session)
+    if isinstance(found, str):
+        return found
+    if not found:
+        return NO_MATCHES
+    return ''.join(sorted("\n" + item.path() for item in found))
+
+
+def vfs_reports(vfs):
+    # what the stats command shows after the counters: the state of the caches
+    # and of the optional subsystems attached to vfs
+    out = vfs.path_cache.report()
+    if vfs.text_index is not None:
+        out += vfs.text_index.report()
+    if vfs.dedup is not None:
+        out += vfs.dedup.report()
+    if vfs.compressor is not None:
+        out += vfs.compressor.report()
+    if vfs.page_cache is not None:
+        out += vfs.page_cache.report()
+    return out
+
+
+@command("stats", "stats <-json>", "Show instrumentation counters (optional: as JSON)", counts=(0, 1))
+def stats(vfs, session, fmt=None):
+    if fmt is None:
+        return VFMS_stats.report() + vfs_reports(vfs)
+    if fmt != "-json":
+        return "Usage: stats <-json>"
+    return "\n" + json.dumps(VFMS_stats.snapshot())
+
+
+@command("sync", "sync", "Flush pending appends and the operation log to disk")
+def sync(vfs, session, *args):
+    return f"\nSynced {vfs.sync()} dirty pages"
+
+
+@command("cache_policy", "cache_policy <lru|clock|2q>", "Switch the page cache eviction policy", counts=(1,))
+def cache_policy(vfs, session, policy):
+    if vfs.page_cache is None:
+        return "\nNo page cache"
+    try:
+        vfs.page_cache.set_policy(policy)
+    except ValueError as error:
+        return f"\n{error}"
+    return f"\nPage cache now evicts by {policy}"
+
+
+@command("help", "help", "Display this help message")
+def help_(vfs, session, *args):
+    out = ["\nAvailable commands:"]
+    for cmd in COMMANDS.values():
+        out.append(f"\n  {cmd.usage:43}{cmd.help[0]}")
+        out.extend(f"\n  {'':43}{line}" for line in cmd.help[1:])
+    return ''.join(out)
+
+
+@command("exit", "exit", "Exit the program", ends_session=True)
+def exit_(vfs, session, *args):
+    session.close_all()
+    return ''
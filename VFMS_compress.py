@@ -0,0 +1,164 @@
+import lzma
+import time
+import zlib
+import threading
+import collections
+
+# Optional background compression of cold files.
+#
+# A Compressor thread wakes every interval seconds and compresses each file
+# that has gone idle seconds without being read or written, is closed and
+# holds at least MIN_SIZE bytes. The file's content is swapped for a
+# Compressed source, just as files restored from a snapshot hold a
+# VFMS_snapshot.Source, so nothing else has to know about it: a write inflates
+# the file for good through File.data, while reads go through File.readable
+# and are served from an LRU cache of decompressed contents, bounded by
+# cache_bytes and evicting the least recently used entries until the new one
+# fits. A file's entry leaves the cache as soon as the file is inflated. Files that don't shrink by at least a tenth are left as they are and
+# not tried again until they change.
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+# files smaller than this are never worth it
+MIN_SIZE = 4096
+
+
+class Compressed:
+    # compressed utf-8 content of a file, standing in for it until written
+    __slots__ = ('compressor', 'blob', 'length')
+    # reads are served from the compressor's cache rather than inflating
+    cached = True
+
+    def __init__(self, compressor, blob, length):
+        self.compressor = compressor
+        self.blob = blob
+        # bytes before compression
+        self.length = length
+
+    def raw(self):
+        return self.compressor.decompress(self.blob)
+
+    def load(self):
+        return self.raw().decode('utf-8')
+
+    def content(self, content_class):
+        return self.compressor.cached(self, content_class)
+
+    def release(self):
+        # the file no longer reads from here
+        self.compressor.uncache(self)
+
+
+class Compressor:
+    def __init__(self, vfs, idle=300.0, codec='zlib', cache_bytes=16 * 1024 * 1024, interval=None):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        self.vfs = vfs
+        self.idle = idle
+        self.codec = codec
+        self.compress, self.decompress = CODECS[codec]
+        self.cache_bytes = cache_bytes
+        self.interval = interval if interval is not None else max(idle / 4, 0.05)
+        # Compressed -> decompressed content object, least recently used first
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        # files that didn't compress well -> their modified_at when tried
+        self.skipped = {}
+        self.hits = self.misses = self.evictions = 0
+        self.compressed = self.bytes_in = self.bytes_out = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        # compress every file that went cold, returning how many were
+        cold = time.time_ns() - int(self.idle * 1e9)
+        count = 0
+        for _file in self.vfs.files(self.vfs.root):
+            if self.stopping.is_set():
+                break
+            if (_file.source is None and _file.size >= MIN_SIZE and _file.open_mode is None
+                    and _file.accessed_at <= cold and self.skipped.get(_file) != _file.modified_at):
+                count += self.compress_file(_file)
+        for _file in [f for f in self.skipped if f.deleted]:
+            del self.skipped[_file]
+        return count
+
+    def compress_file(self, _file):
+        with _file.lock.writing():
+            if _file.deleted or _file.source is not None or _file.open_mode is not None:
+                return 0
+            raw = _file.data.encode()
+            blob = self.compress(raw)
+            if len(blob) > len(raw) * 0.9:
+                self.skipped[_file] = _file.modified_at
+                return 0
+            _file.offload(Compressed(self, blob, len(raw)))
+        self.skipped.pop(_file, None)
+        with self.lock:
+            self.compressed += 1
+            self.bytes_in += len(raw)
+            self.bytes_out += len(blob)
+        return 1
+
+    def cached(self, source, content_class):
+        # decompressed content of source, from the cache when possible
+        with self.lock:
+            content = self.cache.get(source)
+            if content is not None:
+                self.cache.move_to_end(source)
+                self.hits += 1
+                return content
+            self.misses += 1
+        content = content_class.restore(source)
+        with self.lock:
+            if source not in self.cache and source.length <= self.cache_bytes:
+                while self.cached_bytes + source.length > self.cache_bytes:
+                    evicted, _ = self.cache.popitem(last=False)
+                    self.cached_bytes -= evicted.length
+                    self.evictions += 1
+                self.cache[source] = content
+                self.cached_bytes += source.length
+        return content
+
+    def uncache(self, source):
+        with self.lock:
+            if self.cache.pop(source, None) is not None:
+                self.cached_bytes -= source.length
+
+    def stats(self):
+        # compressed files currently in the tree and their sizes
+        files = raw = stored = 0
+        for _file in self.vfs.files(self.vfs.root):
+            source = _file.source
+            if isinstance(source, Compressed):
+                files += 1
+                raw += source.length
+                stored += len(source.blob)
+        with self.lock:
+            return {'codec': self.codec, 'files': files, 'raw_bytes': raw, 'compressed_bytes': stored,
+                    'ratio': raw / stored if stored else 1.0, 'compressed_total': self.compressed,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_evictions': self.evictions,
+                    'cache_bytes': self.cached_bytes, 'cache_capacity': self.cache_bytes}
+
+    def report(self):
+        s = self.stats()
+        return (f"\ncompression ({s['codec']}): {s['files']} files, {s['raw_bytes']}B in {s['compressed_bytes']}B, "
+                f"ratio {s['ratio']:.2f}x; cache {s['cache_hits']} hits, {s['cache_misses']} misses, "
+                f"{s['cache_evictions']} evictions, {s['cache_bytes']}B of {s['cache_capacity']}B")
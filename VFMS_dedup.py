@@ -0,0 +1,135 @@
+import hashlib
+import threading
+
+# Optional content-addressed block sharing for the virtual file system.
+#
+# With a Dedup attached every logical block of a file is hashed and files
+# whose blocks hold the same bytes point at the same physical block, which is
+# reference counted and only goes back to the allocator once nothing uses it.
+# Blocks are never changed in place: when a write or truncate changes a block
+# that other files share, the file being written gets a block of its own (or
+# another shared one matching its new bytes) and the others keep the old one.
+#
+# A change remaps a file from its first changed block to its end, so appends
+# only rehash the tail while write_at rehashes everything after the offset,
+# whose blocks all shift. Blocks restored from a snapshot are shared exactly as
+# they were saved but only join the hash table once rewritten, as hashing them
+# would mean decoding every file up front.
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class Dedup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # forget every block, for a device that was just replaced
+        # digest -> physical block, and back (None for restored blocks)
+        self.table = {}
+        self.digests = {}
+        # physical block -> {(file, logical block): directory name}
+        self.refs = {}
+        self.logical = 0
+
+    def _show(self, vfs, block):
+        # point the memory map cell at one of the block's users
+        (owner, index), dir_name = next(iter(self.refs[block].items()))
+        vfs.memory[block] = (owner, index, dir_name)
+
+    def _detach(self, _file, first):
+        # unmap logical blocks first.. of _file, returning the physical blocks
+        # they used; blocks left without users are not freed yet
+        old = [block for start, length in _file.block_extents(first, _file.blocks - first)
+               for block in range(start, start + length)]
+        _file.drop_blocks(_file.blocks - first)
+        for index, block in enumerate(old, first):
+            del self.refs[block][(_file, index)]
+        self.logical -= len(old)
+        return old
+
+    def _free(self, vfs, blocks, keep=()):
+        # give back blocks nobody uses any more, except those whose digest is
+        # in keep; the rest get a new owner shown in the memory map
+        for block in blocks:
+            if block not in self.refs:
+                continue
+            if self.refs[block]:
+                self._show(vfs, block)
+            elif self.digests[block] not in keep:
+                del self.refs[block]
+                d = self.digests.pop(block)
+                if d is not None:
+                    del self.table[d]
+                vfs.memory[block] = None
+                vfs.allocator.release(block, 1)
+
+    def remap(self, vfs, _file, first, dir_name):
+        # bring the file's blocks from logical block first onwards in line
+        # with its content; runs under the file's write lock
+        with self.lock:
+            first = min(first, _file.blocks)
+            old = self._detach(_file, first)
+            size = vfs.block_size
+            content = _file.data if _file.size else None
+            digests = [digest(content.slice(i * size, size)) for i in range(first, vfs.blocks_needed(_file.size))]
+            keep = set(digests)
+            # first free what is gone for good, so a rewrite can reuse its room
+            self._free(vfs, old, keep)
+            fresh = list(dict.fromkeys(d for d in digests if d not in self.table))
+            extents = vfs.allocator.allocate(min(len(fresh), vfs.allocator.free)) or []
+            blocks = (block for start, length in extents for block in range(start, start + length))
+            for d, block in zip(fresh, blocks):
+                self.table[d] = block
+                self.digests[block] = d
+                self.refs[block] = {}
+            mapped = []
+            for index, d in enumerate(digests, first):
+                block = self.table.get(d)
+                if block is None:
+                    # the device is full, the rest stays unmapped
+                    break
+                self.refs[block][(_file, index)] = dir_name
+                mapped.append((block, 1))
+            _file.add_extents(mapped)
+            self.logical += len(mapped)
+            for block, _ in mapped:
+                self._show(vfs, block)
+            # blocks kept for a digest that ended up not being mapped
+            self._free(vfs, old)
+
+    def drop(self, vfs, _file, first):
+        # unmap logical blocks first.. of _file, as when it shrinks or goes
+        with self.lock:
+            self._free(vfs, self._detach(_file, first))
+
+    def claim(self, vfs, _file, start, count, dir_name):
+        # restore the snapshot run start..start+count-1 as the file's next
+        # blocks, sharing those an earlier file already claimed
+        with self.lock:
+            free = [block for block in range(start, start + count) if block not in self.refs]
+            if len(free) == count:
+                vfs.allocator.claim(start, count)
+            else:
+                for block in free:
+                    vfs.allocator.claim(block, 1)
+            for block in free:
+                self.refs[block] = {}
+                self.digests[block] = None
+            for block in range(start, start + count):
+                self.refs[block][(_file, _file.blocks + block - start)] = dir_name
+                self._show(vfs, block)
+            _file.add_extents([(start, count)])
+            self.logical += count
+
+    def ratio(self):
+        return self.logical / len(self.refs) if self.refs else 1.0
+
+    def report(self):
+        return (f"\ndedup: {self.logical} logical blocks in {len(self.refs)} physical blocks, "
+                f"ratio {self.ratio():.2f}x, {len(self.table)} hashed")
@@ -0,0 +1,186 @@
+import os
+import mmap
+import codecs
+
+# Bulk copies between the host file system and a VirtualFileSystem, behind the
+# import_host and export_host commands.
+#
+# Import walks the host tree once with scandir and checks the whole of it fits
+# on the device before changing anything. It then fills one directory at a
+# time: file contents are read straight into content objects, files of
+# MMAP_MIN bytes and up through mmap a piece at a time and smaller ones with a
+# single read, the blocks of all the directory's new files come from one
+# allocation, and the new entries are published and logged as one group under
+# the directory's lock. Directories that already exist are merged into; files
+# that already exist are left alone and counted as skipped.
+#
+# Export writes everything below a directory under a host directory, each
+# file streamed out with File.read_stream rather than built up as one string.
+
+MMAP_MIN = 64 * 1024
+# bytes copied out of a mapping per append
+PIECE = 1024 * 1024
+
+
+def scan(root):
+    # (path components below root, [(name, host path, size, mtime ns)],
+    # [subdirectory names]) for every host directory, parents first
+    tree = []
+    stack = [(root, ())]
+    while stack:
+        path, parts = stack.pop()
+        files, subdirs = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.name, entry.path, stat.st_size, stat.st_mtime_ns))
+        files.sort()
+        subdirs.sort()
+        tree.append((parts, files, subdirs))
+        stack.extend((os.path.join(path, name), parts + (name,)) for name in reversed(subdirs))
+    return tree
+
+
+def read_content(path, size, content_class):
+    # the host file at path as a content_class object; text storage decodes
+    # it as utf-8, replacing what isn't
+    content = content_class()
+    decoder = None if isinstance(content.EMPTY, bytes) else codecs.getincrementaldecoder('utf-8')('replace')
+
+    def append(data):
+        content.append(decoder.decode(data) if decoder else data)
+
+    with open(path, 'rb') as f:
+        if size >= MMAP_MIN:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                for start in range(0, len(mapping), PIECE):
+                    append(mapping[start:start + PIECE])
+        else:
+            append(f.read())
+    if decoder:
+        content.append(decoder.decode(b'', True))
+    return content
+
+
+def _lookup(directory, parts):
+    # the directory at parts below directory, None if it doesn't exist yet
+    for name in parts:
+        directory = directory.contents.get(name)
+        if directory is None or not hasattr(directory, 'contents'):
+            return None
+    return directory
+
+
+def import_tree(vfs, host_dir, target, file_class, directory_class):
+    if not os.path.isdir(host_dir):
+        return f"\nNo such host directory: {host_dir}"
+    try:
+        tree = scan(host_dir)
+    except OSError as error:
+        return f"\nCannot read {error.filename}: {error.strerror}"
+    # sizes are in bytes, which never undercounts text
+    needed = 0
+    for parts, files, _ in tree:
+        existing = _lookup(target, parts)
+        contents = existing.contents if existing is not None else {}
+        needed += sum(vfs.blocks_needed(size) for name, _, size, _ in files if name not in contents)
+    if needed > vfs.calc_free_memory():
+        return "Cannot import as memory is full"
+    directories = {(): target}
+    imported = created = copied = skipped = 0
+    for parts, files, subdirs in tree:
+        directory = directories.get(parts)
+        if directory is None:
+            # skipped along with its parent
+            continue
+        new = []
+        for name, path, size, mtime in files:
+            if name in directory.contents:
+                skipped += 1
+                continue
+            try:
+                content = read_content(path, size, file_class.content_class)
+            except (OSError, ValueError):
+                skipped += 1
+                continue
+            _file = file_class(name)
+            if len(content):
+                _file.fill(content)
+            _file.created_at = _file.modified_at = mtime
+            new.append(_file)
+        records = []
+        with directory.lock:
+            if directory.deleted:
+                continue
+            # checked again, something may have been created meanwhile
+            fresh = [f for f in new if f.name not in directory.contents]
+            skipped += len(new) - len(fresh)
+            vfs.map_files(fresh, directory.name)
+            for _file in fresh:
+                directory.add_file(_file)
+                vfs.index_entry(_file)
+                records.append(('create', {'path': _file.path()}))
+                if _file.size:
+                    # the stored content, not its text, so binary files are
+                    # logged intact
+                    records.append(('write', {'path': _file.path(), 'data': _file.data.native()}))
+                copied += _file.size
+            imported += len(fresh)
+            for name in subdirs:
+                existing = directory.contents.get(name)
+                if existing is None:
+                    existing = directory_class(name)
+                    directory.add_directory(existing)
+                    vfs.index_entry(existing)
+                    records.append(('mkdir', {'path': existing.path()}))
+                    created += 1
+                elif not hasattr(existing, 'contents'):
+                    # a file is in the way
+                    skipped += 1
+                    continue
+                directories[parts + (name,)] = existing
+            vfs.log_many(records)
+    out = f"\nImported {imported} files ({copied}B) and {created} directories into {target.name}"
+    if skipped:
+        out += f", skipped {skipped} existing or unreadable entries"
+    return out
+
+
+def export_tree(source, host_dir):
+    exported = created = copied = skipped = 0
+    stack = [(source, host_dir)]
+    try:
+        os.makedirs(host_dir, exist_ok=True)
+        while stack:
+            directory, path = stack.pop()
+            for item in list(directory.contents.values()):
+                if item.name in ('.', '..') or os.sep in item.name:
+                    # not a name the host can hold
+                    skipped += 1
+                    continue
+                target = os.path.join(path, item.name)
+                if hasattr(item, 'contents'):
+                    os.makedirs(target, exist_ok=True)
+                    created += 1
+                    stack.append((item, target))
+                    continue
+                stream = item.read_stream()
+                if isinstance(stream, str):
+                    # open for writing
+                    skipped += 1
+                    continue
+                with open(target, 'wb') as f:
+                    for piece in stream.encoded():
+                        f.write(piece)
+                os.utime(target, ns=(item.modified_at, item.modified_at))
+                exported += 1
+                copied += len(stream)
+    except OSError as error:
+        return f"\nCannot write {error.filename}: {error.strerror}"
+    out = f"\nExported {exported} files ({copied}B) and {created} directories to {host_dir}"
+    if skipped:
+        out += f", skipped {skipped} entries"
+    return out
@@ -0,0 +1,91 @@
+import sys
+import time
+import asyncio
+import argparse
+import collections
+
+# Load generator for VFMS_server.py: opens --clients concurrent connections,
+# each pipelining its own script with up to --window commands in flight, and
+# reports throughput and reply latency.
+#
+#   python VFMS_loadgen.py [--port 7000 | --unix PATH] [--clients 100] [--ops 200]
+
+
+def script(client, ops):
+    # every client works in its own directory
+    lines = [f"mkdir c{client}", f"chdir c{client}"]
+    for i in range(ops):
+        name = f"f{i % 16}.txt"
+        step = i % 6
+        if step == 0:
+            lines.append(f"create {name}")
+        elif step == 1:
+            lines.append(f"open {name} w")
+        elif step == 2:
+            lines.append(f"write_to_file {name} data{i}")
+        elif step == 3:
+            lines.append(f"close {name}")
+        elif step == 4:
+            lines.append(f"read_from_file {name} 0 4")
+        else:
+            lines.append("ls")
+    lines.append("exit")
+    return lines
+
+
+async def run_client(args, client, latencies):
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix, limit=1 << 20)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port, limit=1 << 20)
+    lines = script(client, args.ops)
+    window = asyncio.Semaphore(args.window)
+    sent = collections.deque()
+
+    async def send():
+        for line in lines:
+            await window.acquire()
+            sent.append(time.perf_counter())
+            writer.write(line.encode('utf-8') + b'\n')
+            await writer.drain()
+
+    async def receive():
+        for _ in lines:
+            length = int(await reader.readline())
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - sent.popleft())
+            window.release()
+
+    await asyncio.gather(send(), receive())
+    writer.close()
+    return len(lines)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    latencies = []
+    start = time.perf_counter()
+    counts = await asyncio.gather(*(run_client(args, c, latencies) for c in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    total = sum(counts)
+    print(f"clients {args.clients}  commands {total}  elapsed {elapsed:.2f}s  {total / elapsed:.0f} cmd/s")
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.2f}ms  p99 {percentile(latencies, 0.99) * 1000:.2f}ms")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Drive a running VFMS_server.py with concurrent pipelined sessions")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--unix', help="connect to this Unix socket path instead of TCP")
+    parser.add_argument('--clients', type=int, default=100, help="concurrent sessions (mind ulimit -n)")
+    parser.add_argument('--ops', type=int, default=200, help="commands per session")
+    parser.add_argument('--window', type=int, default=16, help="commands in flight per session")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,351 @@
+import time
+import threading
+import collections
+
+# Optional page cache between the File API and file contents.
+#
+# Contents live in each file's content object rather than on the simulated
+# device, so the cache works on pages of page_size characters (bytes with
+# byte storage) of those contents, keyed by (file, page index). It caches
+# clean pages for offset reads, which saves going back to the content, and to
+# a decompressed copy for files the Compressor has squeezed. Appends are
+# write-back: they land in dirty pages and only reach the file, the text
+# index, the write-ahead log and the block map when the file is flushed, as
+# one write for everything appended since. A file is flushed when one of its
+# dirty pages is evicted, when it is closed, before anything reads, rewrites
+# or truncates it, and by sync, which flushes every file. Until then the
+# appended data is acknowledged but not yet in the log.
+#
+# Which page goes when the cache is full is up to a pluggable policy, with
+# hits, misses, evictions and write-backs counted per policy:
+#   lru    least recently used
+#   clock  second chance: a hand sweeps the pages, sparing those used since
+#          it last passed them
+#   2q     new pages wait in a FIFO and only pages used again after falling
+#          out of it (remembered in a ghost list) reach the main LRU, so one
+#          scan through a big file can't flush out the pages in regular use
+
+
+class LRUPolicy:
+    name = 'lru'
+
+    def __init__(self, capacity):
+        self.order = collections.OrderedDict()
+
+    def admit(self, key):
+        self.order[key] = None
+
+    def hit(self, key):
+        self.order.move_to_end(key)
+
+    def evict(self):
+        return self.order.popitem(last=False)[0]
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+
+class ClockPolicy:
+    name = 'clock'
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.referenced = [False] * capacity
+        # key -> its slot
+        self.where = {}
+        self.empty = list(range(capacity - 1, -1, -1))
+        self.hand = 0
+
+    def admit(self, key):
+        slot = self.empty.pop()
+        self.slots[slot] = key
+        self.referenced[slot] = True
+        self.where[key] = slot
+
+    def hit(self, key):
+        self.referenced[self.where[key]] = True
+
+    def evict(self):
+        while True:
+            slot = self.hand
+            self.hand = (slot + 1) % len(self.slots)
+            if self.slots[slot] is None:
+                continue
+            if self.referenced[slot]:
+                self.referenced[slot] = False
+                continue
+            key = self.slots[slot]
+            self.remove(key)
+            return key
+
+    def remove(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            self.slots[slot] = None
+            self.empty.append(slot)
+
+
+class TwoQPolicy:
+    name = '2q'
+
+    def __init__(self, capacity):
+        # sizes suggested with the algorithm: a quarter of the cache for new
+        # pages, ghosts for half as many pages as the cache holds
+        self.in_size = max(capacity // 4, 1)
+        self.out_size = max(capacity // 2, 1)
+        self.a1in = collections.OrderedDict()
+        self.a1out = collections.OrderedDict()
+        self.am = collections.OrderedDict()
+
+    def admit(self, key):
+        if key in self.a1out:
+            # seen again soon after leaving a1in
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+
+    def hit(self, key):
+        if key in self.am:
+            self.am.move_to_end(key)
+
+    def evict(self):
+        if len(self.a1in) > self.in_size or not self.am:
+            key = self.a1in.popitem(last=False)[0]
+            self.a1out[key] = None
+            if len(self.a1out) > self.out_size:
+                self.a1out.popitem(last=False)
+            return key
+        return self.am.popitem(last=False)[0]
+
+    def remove(self, key):
+        self.a1in.pop(key, None)
+        self.a1out.pop(key, None)
+        self.am.pop(key, None)
+
+
+POLICIES = {policy.name: policy for policy in (LRUPolicy, ClockPolicy, TwoQPolicy)}
+
+# stands in the page table for pages holding appended data not yet flushed,
+# which itself is kept per file in PageCache.dirty
+DIRTY = object()
+
+
+class PageCache:
+    def __init__(self, vfs, capacity=1024, policy='lru', page_size=4096):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        if capacity < 1 or page_size < 1:
+            raise ValueError("Page cache needs room for at least one page")
+        self.vfs = vfs
+        self.capacity = capacity
+        self.page_size = page_size
+        self.policy = POLICIES[policy](capacity)
+        # (file, page index) -> page content or DIRTY
+        self.pages = {}
+        # file -> indexes of its pages in the cache
+        self.resident = {}
+        # file -> {page index: data appended to that page}, in order
+        self.dirty = {}
+        # file -> length of its dirty data, and the total over all files
+        self.pending = {}
+        self.pending_units = 0
+        # file -> count of changes, so a page read before one isn't cached
+        self.versions = {}
+        # files being flushed right now
+        self.flushing = set()
+        self.lock = threading.Lock()
+        # one flush at a time, so appends reach each file in order
+        self.flush_lock = threading.RLock()
+        # policy name -> counters
+        self.counters = {}
+        self.count = self._counter(policy)
+
+    def _counter(self, policy):
+        return self.counters.setdefault(policy, {'hits': 0, 'misses': 0, 'evictions': 0, 'writebacks': 0})
+
+    def set_policy(self, policy):
+        # switch to another eviction policy, keeping the cached pages; the
+        # counters so far stay with the policy that earned them
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        with self.lock:
+            self.policy = POLICIES[policy](self.capacity)
+            for key in self.pages:
+                self.policy.admit(key)
+            self.count = self._counter(policy)
+
+    def _admit(self, key, value):
+        # add a page, evicting as needed; returns the files whose dirty pages
+        # were evicted and so need flushing, to be done without the lock
+        victims = []
+        while len(self.pages) >= self.capacity:
+            old = self.policy.evict()
+            if self._drop(old) is DIRTY:
+                victims.append(old[0])
+            self.count['evictions'] += 1
+        self.pages[key] = value
+        self.policy.admit(key)
+        self.resident.setdefault(key[0], set()).add(key[1])
+        return victims
+
+    def _drop(self, key):
+        # take a page out of the table, returning what it held
+        value = self.pages.pop(key)
+        indexes = self.resident[key[0]]
+        indexes.discard(key[1])
+        if not indexes:
+            del self.resident[key[0]]
+        return value
+
+    def _remove(self, key):
+        self.policy.remove(key)
+        return self._drop(key)
+
+    def write(self, _file, data):
+        # buffer data appended to _file, as File.write would take it
+        if _file.open_mode is None or 'w' not in _file.open_mode and 'a' not in _file.open_mode:
+            return _file.write(data)
+        data = _file.content_class.coerce(data)
+        size = self.page_size
+        victims = []
+        with self.lock:
+            pages = self.dirty.setdefault(_file, {})
+            position = _file.size + self.pending.get(_file, 0)
+            self.pending[_file] = self.pending.get(_file, 0) + len(data)
+            self.pending_units += len(data)
+            while data:
+                index, offset = divmod(position, size)
+                piece, data = data[:size - offset], data[size - offset:]
+                position += len(piece)
+                key = (_file, index)
+                pages[index] = pages[index] + piece if index in pages else piece
+                value = self.pages.get(key)
+                if value is DIRTY:
+                    self.policy.hit(key)
+                    continue
+                if value is not None:
+                    # the clean copy misses what was just appended
+                    self._remove(key)
+                victims += self._admit(key, DIRTY)
+        for victim in dict.fromkeys(victims):
+            self.flush(victim)
+        return f"\nSuccessfuly written to file {_file.name}"
+
+    def flush(self, _file):
+        # write what was appended to _file through to it, returning how many
+        # dirty pages that took
+        with self.lock:
+            if _file not in self.dirty and _file not in self.flushing:
+                return 0
+        with self.flush_lock:
+            with self.lock:
+                pages = self.dirty.pop(_file, None)
+                if not pages:
+                    return 0
+                self.pending_units -= self.pending.pop(_file)
+                for index in pages:
+                    key = (_file, index)
+                    if self.pages.get(key) is DIRTY:
+                        self._remove(key)
+                self.flushing.add(_file)
+                self.count['writebacks'] += 1
+            pieces = list(pages.values())
+            data = pieces[0][:0].join(pieces)
+            try:
+                self.vfs.apply_write(_file, data, None, lambda: _file.append(data))
+            finally:
+                with self.lock:
+                    self.flushing.discard(_file)
+            return len(pages)
+
+    def sync(self):
+        # flush every file, returning how many dirty pages there were
+        with self.lock:
+            files = list(self.dirty)
+        return sum(self.flush(_file) for _file in files)
+
+    def page(self, _file, index):
+        key = (_file, index)
+        with self.lock:
+            value = self.pages.get(key)
+            if value is not None and value is not DIRTY:
+                self.count['hits'] += 1
+                self.policy.hit(key)
+                return value
+            self.count['misses'] += 1
+            version = self.versions.get(_file, 0)
+        with _file.lock.reading():
+            value = _file.readable.slice(index * self.page_size, self.page_size)
+        victims = []
+        with self.lock:
+            if self.versions.get(_file, 0) == version and key not in self.pages and not _file.deleted:
+                victims = self._admit(key, value)
+        for victim in dict.fromkeys(victims):
+            self.flush(victim)
+        return value
+
+    def read_at(self, _file, offset, length):
+        # File.read_at served from cached pages
+        self.flush(_file)
+        if (_file.open_mode is not None and 'r' not in _file.open_mode
+                or offset < 0 or offset >= _file.size or length <= 0):
+            return _file.read_at(offset, length)
+        _file.accessed_at = time.time_ns()
+        end = min(offset + length, _file.size)
+        size = self.page_size
+        pieces = []
+        for index in range(offset // size, (end - 1) // size + 1):
+            base = index * size
+            pieces.append(self.page(_file, index)[max(offset - base, 0):end - base])
+        return pieces[0][:0].join(pieces)
+
+    def invalidate(self, _file, offset=0):
+        # drop the clean pages of _file from the one holding offset onwards,
+        # after it changed there
+        first = offset // self.page_size
+        with self.lock:
+            self.versions[_file] = self.versions.get(_file, 0) + 1
+            for index in [i for i in self.resident.get(_file, ()) if i >= first]:
+                key = (_file, index)
+                if self.pages[key] is not DIRTY:
+                    self._remove(key)
+
+    def forget(self, _file):
+        # drop everything held for a file that is gone, unflushed data too
+        with self.lock:
+            for index in list(self.resident.get(_file, ())):
+                self._remove((_file, index))
+            if self.dirty.pop(_file, None):
+                self.pending_units -= self.pending.pop(_file)
+            self.versions.pop(_file, None)
+
+    def pending_size(self, _file):
+        # length of what was appended to _file and not flushed yet
+        with self.lock:
+            return self.pending.get(_file, 0)
+
+    def pending_blocks(self):
+        # blocks the unflushed data will need, at most
+        with self.lock:
+            return -(-self.pending_units // self.vfs.block_size) + len(self.pending)
+
+    def stats(self):
+        with self.lock:
+            dirty = sum(len(pages) for pages in self.dirty.values())
+            out = {'policy': self.policy.name, 'capacity': self.capacity, 'page_size': self.page_size,
+                   'pages': len(self.pages), 'dirty': dirty, 'pending_units': self.pending_units, 'policies': {}}
+            for name, count in self.counters.items():
+                lookups = count['hits'] + count['misses']
+                out['policies'][name] = dict(count, hit_rate=count['hits'] / lookups if lookups else 0.0)
+            return out
+
+    def report(self):
+        s = self.stats()
+        out = [f"\npage cache ({s['policy']}): {s['pages']} of {s['capacity']} pages of {s['page_size']}, "
+               f"{s['dirty']} dirty"]
+        for name, count in s['policies'].items():
+            out.append(f"\n  {name}: {count['hits']} hits, {count['misses']} misses, "
+                       f"hit rate {count['hit_rate']:.1%}, {count['evictions']} evictions, "
+                       f"{count['writebacks']} write-backs")
+        return ''.join(out)
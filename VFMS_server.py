@@ -0,0 +1,195 @@
+import sys
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import VFMS_threaded
+from VFMS_threaded import VirtualFileSystem
+from VFMS_wal import WriteAheadLog, recover, checkpoint
+import VFMS_commands
+import VFMS_stats
+from VFMS_textindex import TextIndex
+from VFMS_dedup import Dedup
+from VFMS_compress import Compressor, CODECS
+from VFMS_pagecache import PageCache, POLICIES
+
+# Network front end: one asyncio server, one Session per connection, all of
+# them sharing a single VirtualFileSystem.
+#
+# Protocol: the client sends commands as lines, exactly as in an
+# input_thread#.txt script. Every line gets one reply, in order, framed as the
+# byte length of the output on its own line followed by the utf-8 output.
+# Clients may pipeline: commands are read ahead up to --pipeline per
+# connection while earlier ones run. Within a connection commands run one after
+# another so they see each other's effects; connections run in parallel on a
+# bounded thread pool. A streamed read of a large file is written to the
+# socket piece by piece as the client drains it, never as one buffer.
+#
+#   python VFMS_server.py [--port 7000 | --unix PATH] [--workers 8]
+
+log = logging.getLogger('VFMS_server')
+
+def ends_session(invocation):
+    return invocation[0] is not None and invocation[0].ends_session
+
+
+class Server:
+    def __init__(self, vfs, workers=8, pipeline=64):
+        self.vfs = vfs
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pipeline = pipeline
+        self.sessions = 0
+
+    def run_batch(self, session, batch):
+        # runs on a pool thread; everything queued for the connection goes in
+        # one hop, stopping at a command that ends the session
+        out = []
+        for invocation in batch:
+            out.append(VFMS_commands.execute(self.vfs, session, invocation))
+            if ends_session(invocation):
+                break
+        return out
+
+    async def respond(self, session, queue, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            while batch[-1] is not None and not queue.empty():
+                batch.append(queue.get_nowait())
+            finished = batch[-1] is None
+            if finished:
+                batch.pop()
+            if batch:
+                outputs = await loop.run_in_executor(self.pool, self.run_batch, session, batch)
+                for text in outputs:
+                    if isinstance(text, str):
+                        data = text.encode('utf-8')
+                        writer.write(b'%d\n' % len(data) + data)
+                    else:
+                        await self.stream(text, writer)
+                await writer.drain()
+                if ends_session(batch[-1]):
+                    return
+            if finished:
+                return
+
+    async def stream(self, content, writer):
+        if content.binary:
+            length = len(content)
+        else:
+            # the utf-8 length has to go out first; it is counted on a pool
+            # thread, encoding one piece at a time, and the pieces are encoded
+            # again as they are sent
+            length = await asyncio.get_running_loop().run_in_executor(self.pool, content.encoded_length)
+        writer.write(b'%d\n' % length)
+        pending = 0
+        for piece in content.encoded():
+            writer.write(piece)
+            pending += len(piece)
+            if pending >= VFMS_commands.STREAM_CHUNK:
+                await writer.drain()
+                pending = 0
+
+    async def handle(self, reader, writer):
+        session = self.vfs.new_session()
+        self.sessions += 1
+        queue = asyncio.Queue(self.pipeline)
+        responder = asyncio.create_task(self.respond(session, queue, writer))
+
+        def hang_up(task):
+            # a responder that failed answers nothing more, so stop reading as
+            # if the client had gone
+            if not task.cancelled() and task.exception() is not None:
+                writer.close()
+
+        responder.add_done_callback(hang_up)
+        try:
+            while not responder.done():
+                line = await reader.readline()
+                if not line:
+                    break
+                invocation = VFMS_commands.parse(line.decode('utf-8', 'replace'))
+                # blank lines still get an (empty) reply to keep replies aligned
+                await queue.put(invocation or (None, ''))
+                if invocation and ends_session(invocation):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            try:
+                if not responder.done():
+                    await queue.put(None)
+                await responder
+            except ConnectionError:
+                pass
+            except Exception:
+                log.exception("Session ended by an unexpected error")
+            finally:
+                session.close_all()
+                self.sessions -= 1
+                writer.close()
+
+    async def serve(self, host='127.0.0.1', port=7000, unix=None):
+        if unix:
+            server = await asyncio.start_unix_server(self.handle, path=unix, limit=1 << 20, backlog=4096)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=1 << 20, backlog=4096)
+        async with server:
+            print(f"VFMS serving on {unix or f'{host}:{port}'}", flush=True)
+            await server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve a VirtualFileSystem over TCP or a Unix socket")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    parser.add_argument('--workers', type=int, default=8, help="threads running commands")
+    parser.add_argument('--pipeline', type=int, default=64, help="commands read ahead per connection")
+    parser.add_argument('--blocks', type=int, default=64, help="device size for a fresh file system")
+    parser.add_argument('--stats', action='store_true', help="collect counters for the stats command")
+    parser.add_argument('--text-index', type=int, default=0, metavar='MB', help="keep a trigram index for grep of up to MB")
+    parser.add_argument('--dedup', action='store_true', help="share blocks with identical contents between files")
+    parser.add_argument('--compress-idle', type=float, default=0, metavar='SEC',
+                        help="compress files idle for SEC seconds, reading them back through a cache")
+    parser.add_argument('--compress-codec', choices=list(CODECS), default='zlib')
+    parser.add_argument('--compress-cache', type=int, default=16, metavar='MB', help="decompressed content kept for reads")
+    parser.add_argument('--page-cache', type=int, default=0, metavar='PAGES',
+                        help="cache up to PAGES pages of file contents, holding back appends until flushed")
+    parser.add_argument('--page-policy', choices=list(POLICIES), default='lru', help="page cache eviction policy")
+    parser.add_argument('--storage', choices=('str', 'bytes'), default='str', help="keep file contents as text or utf-8")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        VFMS_stats.install(vars(VFMS_threaded))
+    if args.storage == 'bytes':
+        VFMS_threaded.File.content_class = VFMS_threaded.ByteContent
+    vfs = VirtualFileSystem(num_blocks=args.blocks)
+    if args.text_index:
+        vfs.text_index = TextIndex(args.text_index * 1024 * 1024)
+    if args.dedup:
+        vfs.dedup = Dedup()
+    if args.page_cache:
+        vfs.page_cache = PageCache(vfs, args.page_cache, args.page_policy)
+    lsn = recover(vfs, "VFMS.ckpt", "VFMS.log")
+    vfs.wal = WriteAheadLog("VFMS.log", lsn=lsn)
+    if args.compress_idle:
+        vfs.compressor = Compressor(vfs, args.compress_idle, args.compress_codec, args.compress_cache * 1024 * 1024)
+        vfs.compressor.start()
+    server = Server(vfs, args.workers, args.pipeline)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown()
+        if vfs.compressor is not None:
+            vfs.compressor.stop()
+        checkpoint(vfs, "VFMS.ckpt", vfs.wal)
+        vfs.wal.close()
+        if args.stats:
+            VFMS_stats.dump("VFMS_stats.json")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,452 @@
+import sys
+import json
+import zlib
+import argparse
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import Future
+import VFMS_threaded
+from VFMS_threaded import VirtualFileSystem, File
+from VFMS_wal import WriteAheadLog, recover, checkpoint
+import VFMS_commands
+import VFMS_stats
+
+# Sharded engine: the namespace is split by top-level name across worker
+# processes, each owning a VirtualFileSystem (and its own block device) for
+# the top-level directories and root files that hash to it, so command work
+# runs on as many cores as there are shards instead of under one GIL.
+#
+# A ShardRouter in the calling process keeps each session's working directory
+# as a path and forwards every command to the shard owning it. Commands run at
+# the root that don't name an entry (ls, show_memory_map, export_host), and
+# find, go to every shard and their output is merged. move_file between two
+# shards runs as a two-phase commit: the source shard pins the file, the
+# target shard builds a copy with its blocks reserved but keeps it out of the
+# directory, and only when both are prepared is the copy published and then
+# the original deleted; otherwise both sides are rolled back. While pinned a
+# file refuses every command naming it. If the target directory was removed,
+# or the name taken, between prepare and commit, the copy is dropped and the
+# move rolled back.
+#
+# The decisions live only in the router, so the commit is not crash-safe: the
+# target logs and syncs the copy before the source logs the delete, so a crash
+# between the two leaves the file on both shards, never on neither.
+#
+#   python VFMS_shard.py <number_of_threads> [--shards 4]
+
+# commands whose first argument names a file in the working directory
+FILE_COMMANDS = ('delete', 'move', 'open', 'close', 'write_to_file', 'read_from_file', 'truncate')
+
+
+def shard_of(name, shards):
+    # stable across processes and runs, unlike hash()
+    return zlib.crc32(name.encode('utf-8')) % shards
+
+
+def normalize(cwd, path):
+    # absolute form of path taken from cwd, '..' stopping at the root
+    parts = [] if path.startswith('/') else [p for p in cwd.split('/') if p]
+    for component in path.split('/'):
+        if component in ('', '.'):
+            continue
+        if component == '..':
+            if parts:
+                parts.pop()
+        else:
+            parts.append(component)
+    return '/' + '/'.join(parts)
+
+
+class Shard:
+    # the worker side: one VirtualFileSystem serving requests one at a time
+    def __init__(self, index, num_blocks, policy, block_size, persist):
+        self.index = index
+        self.vfs = VirtualFileSystem(num_blocks, policy, block_size)
+        self.sessions = {}
+        # txid -> (file, directory) prepared for a move out or in
+        self.outgoing = {}
+        self.incoming = {}
+        self.pinned = set()
+        self.persist = persist
+        if persist:
+            lsn = recover(self.vfs, f"VFMS.shard{index}.ckpt", f"VFMS.shard{index}.log")
+            self.vfs.wal = WriteAheadLog(f"VFMS.shard{index}.log", lsn=lsn)
+
+    def session(self, session_id, cwd):
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = self.vfs.new_session()
+        # a session keeps its directory object even after it is deleted, as in
+        # the single process engine; only a change of path walks again
+        if session.current_directory.path() != cwd:
+            directory, missing = self.vfs.walk(cwd, self.vfs.root)
+            if directory is None:
+                return None, f"\nNo such directory: {missing}"
+            session.current_directory = directory
+        return session, None
+
+    def run(self, session_id, cwd, name, args):
+        session, error = self.session(session_id, cwd)
+        if session is None:
+            return error, cwd
+        if self.pinned and name in FILE_COMMANDS and session.current_directory.contents.get(args[0]) in self.pinned:
+            return f"\nFile {args[0]} is being moved", cwd
+        output = VFMS_commands.execute(self.vfs, session, (VFMS_commands.COMMANDS[name], args))
+        if not isinstance(output, str):
+            # a streamed read can't cross the pipe as it is
+            output = str(output)
+        return output, session.current_directory.path()
+
+    def end_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close_all()
+        if self.vfs.wal is not None:
+            self.vfs.wal.flush()
+        return ''
+
+    def prepare_out(self, txid, cwd, name):
+        directory, missing = self.vfs.walk(cwd, self.vfs.root)
+        if directory is None:
+            return f"\nNo such directory: {missing}"
+        with directory.lock:
+            if directory.deleted:
+                return f"\nNo such directory: {directory.name}"
+            _file = directory.get_file(name)
+            if not _file or _file in self.pinned:
+                return f"\nNo such file: {name}"
+            if _file.open_mode is not None:
+                return f"\nFile {name} is open"
+            self.pinned.add(_file)
+            self.outgoing[txid] = (_file, directory)
+            # as stored, so byte storage moves binary files intact
+            return {'content': _file.readable.native(), 'created_at': _file.created_at,
+                    'modified_at': _file.modified_at}
+
+    def prepare_in(self, txid, path, name, state):
+        target, missing = self.vfs.walk(path, self.vfs.root)
+        if target is None:
+            return f"\nNo such directory: {missing}"
+        with target.lock:
+            if target.deleted:
+                return f"\nNo such directory: {target.name}"
+            if name in target.contents:
+                return f"\n{name} already exists in {target.name}"
+            if self.vfs.blocks_needed(len(state['content'])) > self.vfs.calc_free_memory():
+                return "Cannot move file as memory is full"
+            _file = File(name, state['content'])
+            _file.created_at = state['created_at']
+            _file.modified_at = state['modified_at']
+            # labelled with its directory on the map, but not in it until the
+            # commit, so nothing can see or change it before then
+            _file.parent = target
+            self.vfs.update_mmap(_file)
+            self.incoming[txid] = (_file, target)
+            return None
+
+    def commit_out(self, txid):
+        _file, directory = self.outgoing.pop(txid)
+        self.pinned.discard(_file)
+        with directory.lock:
+            # an rmdir of its directory may have released it already
+            if not directory.deleted and directory.contents.get(_file.name) is _file:
+                directory.remove_file(_file)
+                self.vfs.discard_file(_file)
+                self.vfs.unindex_entry(_file)
+                self.vfs.log('delete', path=_file.path())
+
+    def abort_out(self, txid):
+        _file, directory = self.outgoing.pop(txid)
+        self.pinned.discard(_file)
+
+    def commit_in(self, txid):
+        # publish the copy, or return why it can't be and give back its blocks
+        _file, target = self.incoming.pop(txid)
+        with target.lock:
+            if target.deleted:
+                error = f"\nNo such directory: {target.name}"
+            elif _file.name in target.contents:
+                error = f"\n{_file.name} already exists in {target.name}"
+            else:
+                target.add_file(_file)
+                self.vfs.index_entry(_file)
+                self.vfs.log('create', path=_file.path())
+                if _file.size:
+                    self.vfs.log('write', path=_file.path(), data=_file.data.native())
+                error = None
+        if error is not None:
+            self.vfs.discard_file(_file)
+            return error
+        if self.vfs.wal is not None:
+            # durable before the source logs the delete
+            self.vfs.wal.flush()
+        return None
+
+    def stats(self):
+        # this shard's counters and the report lines on its caches
+        return VFMS_stats.snapshot(), VFMS_commands.vfs_reports(self.vfs)
+
+    def stop(self):
+        if self.persist:
+            checkpoint(self.vfs, f"VFMS.shard{self.index}.ckpt", self.vfs.wal)
+            self.vfs.wal.close()
+
+
+class ShardError(Exception):
+    # a request that raised inside a shard process, with the shard's traceback
+    def __init__(self, message, trace=''):
+        super().__init__(message)
+        self.trace = trace
+
+
+def serve_shard(conn, index, num_blocks, policy, block_size, persist, stats=False):
+    # process entry point: answer (request id, method, args) messages in order
+    # with (request id, result, error), error being None or the traceback of
+    # what the request raised
+    if stats:
+        VFMS_stats.install(vars(VFMS_threaded))
+    shard = Shard(index, num_blocks, policy, block_size, persist)
+    while True:
+        try:
+            request_id, method, args = conn.recv()
+        except EOFError:
+            break
+        try:
+            conn.send((request_id, getattr(shard, method)(*args), None))
+        except Exception:
+            conn.send((request_id, None, traceback.format_exc()))
+        if method == 'stop':
+            break
+    conn.close()
+
+
+class ShardLink:
+    # router end of one shard's pipe; any number of threads may call() at once
+    # and replies are matched back to them by request id
+    def __init__(self, conn, process):
+        self.conn = conn
+        self.process = process
+        self.lock = threading.Lock()
+        self.replies = {}
+        self.next_id = 0
+        self.stopped = False
+        self.reader = threading.Thread(target=self.receive, daemon=True)
+        self.reader.start()
+
+    def call(self, method, *args):
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                raise ShardError("Shard stopped before replying")
+            self.next_id += 1
+            self.replies[self.next_id] = future
+            self.conn.send((self.next_id, method, args))
+        return future.result()
+
+    def receive(self):
+        while True:
+            try:
+                request_id, result, error = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self.replies.pop(request_id)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(ShardError(error.strip().splitlines()[-1], error))
+        # the shard is gone, nothing else is going to be answered
+        with self.lock:
+            self.stopped = True
+            pending, self.replies = self.replies, {}
+        for future in pending.values():
+            future.set_exception(ShardError("Shard stopped before replying"))
+
+
+class RouterSession:
+    def __init__(self, session_id):
+        self.id = session_id
+        self.cwd = '/'
+
+
+class ShardRouter:
+    def __init__(self, shards=4, num_blocks=64, policy='first', block_size=1, persist=False, stats=False):
+        context = multiprocessing.get_context('spawn')
+        self.links = []
+        for index in range(shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=serve_shard,
+                                      args=(child, index, num_blocks, policy, block_size, persist, stats),
+                                      daemon=True)
+            process.start()
+            child.close()
+            self.links.append(ShardLink(parent, process))
+        self.ids = 0
+        self.txids = 0
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        with self.lock:
+            self.ids += 1
+            return RouterSession(self.ids)
+
+    def owner(self, path):
+        # shard holding an absolute path other than the root
+        return self.links[shard_of(path.split('/')[1], len(self.links))]
+
+    def home(self, session, name):
+        # shard that owns name inside the session's working directory
+        if session.cwd == '/':
+            return self.owner('/' + name)
+        return self.owner(session.cwd)
+
+    def run(self, link, session, name, args, cwd=None):
+        # (output, working directory afterwards) of one command on one shard
+        return link.call('run', session.id, cwd or session.cwd, name, args)
+
+    def execute(self, session, invocation):
+        cmd, args = invocation
+        if cmd is None:
+            return args
+        name = cmd.name
+        if name == 'help':
+            return VFMS_commands.execute(None, None, invocation)
+        if name == 'exit':
+            for link in self.links:
+                link.call('end_session', session.id)
+            return ''
+        if name == 'chdir':
+            return self.change_directory(session, args[0])
+        if name == 'move':
+            return self.move_file(session, args[0], args[1])
+        if name in ('ls', 'show_memory_map'):
+            if session.cwd != '/':
+                return self.run(self.owner(session.cwd), session, name, args)[0]
+            return self.merge(name, [self.run(link, session, name, args)[0] for link in self.links])
+        if name == 'stats':
+            return self.stats(*args)
+        if name in ('sync', 'cache_policy'):
+            return self.merge(name, [self.run(link, session, name, args)[0] for link in self.links])
+        if name == 'find':
+            # the index is global, so every shard searches from its root
+            return self.merge(name, [self.run(link, session, name, args, cwd='/')[0] for link in self.links])
+        if name == 'grep':
+            scope = normalize(session.cwd, args[1]) if len(args) > 1 else session.cwd
+            if scope != '/':
+                return self.run(self.owner(scope), session, name, [args[0], scope], cwd='/')[0]
+            return self.merge(name, [self.run(link, session, name, args, cwd='/')[0] for link in self.links])
+        if name in ('import_host', 'export_host'):
+            host, path = (args[0], args[1]) if name == 'import_host' else (args[1], args[0])
+            scope = normalize(session.cwd, path)
+            args = [host, scope] if name == 'import_host' else [scope, host]
+            if scope != '/':
+                return self.run(self.owner(scope), session, name, args, cwd='/')[0]
+            if name == 'import_host':
+                # every shard would take the whole tree
+                return "\nImport into a directory below the root when sharded"
+            # shards hold disjoint top-level names, so they can all export at once
+            return ''.join(self.run(link, session, name, args, cwd='/')[0] for link in self.links)
+        return self.run(self.home(session, args[0]), session, name, args)[0]
+
+    def stats_snapshot(self):
+        # the counters of every shard added up, None unless collected
+        return VFMS_stats.merge([link.call('stats')[0] for link in self.links])
+
+    def stats(self, fmt=None):
+        replies = [link.call('stats') for link in self.links]
+        merged = VFMS_stats.merge([snapshot for snapshot, _ in replies])
+        if fmt is None:
+            return VFMS_stats.report(merged) + ''.join(f"\n\nShard {i}:{reports}"
+                                                       for i, (_, reports) in enumerate(replies))
+        if fmt != "-json":
+            return "Usage: stats <-json>"
+        return "\n" + json.dumps(merged)
+
+    def merge(self, name, outputs):
+        if name == 'ls':
+            # one header, then every shard's rows
+            header = outputs[0].split('\n', 2)[:2]
+            skip = len('\n'.join(header))
+            return outputs[0] + ''.join(out[skip:] for out in outputs[1:])
+        if name in ('find', 'grep'):
+            found = [out for out in outputs if out != VFMS_commands.NO_MATCHES]
+            if not found:
+                return VFMS_commands.NO_MATCHES
+            if not found[0].startswith('\n/'):
+                # a usage error, the same from every shard
+                return found[0]
+            return ''.join(sorted('\n' + line for out in found for line in out.split('\n') if line))
+        return ''.join(f"\n\nShard {i}:{out}" for i, out in enumerate(outputs))
+
+    def change_directory(self, session, path):
+        target = normalize(session.cwd, path)
+        if target == '/':
+            session.cwd = '/'
+            return "\nSuccessfuly moved to directory: root"
+        output, after = self.run(self.owner(target), session, 'chdir', [target], cwd='/')
+        if after != '/':
+            session.cwd = after
+        return output
+
+    def move_file(self, session, name, path):
+        target = normalize(session.cwd, path)
+        source = self.home(session, name)
+        destination = self.owner('/' + name) if target == '/' else self.owner(target)
+        if source is destination:
+            return self.run(source, session, 'move', [name, path])[0]
+        with self.lock:
+            self.txids += 1
+            txid = self.txids
+        state = source.call('prepare_out', txid, session.cwd, name)
+        if isinstance(state, str):
+            return state
+        error = destination.call('prepare_in', txid, target, name, state)
+        if error is not None:
+            source.call('abort_out', txid)
+            return error
+        error = destination.call('commit_in', txid)
+        if error is not None:
+            source.call('abort_out', txid)
+            return error
+        source.call('commit_out', txid)
+        return f"\n{name} has been moved to {path}"
+
+    def close(self):
+        for link in self.links:
+            link.call('stop')
+            link.process.join()
+            link.conn.close()
+
+
+def terminal(router, t_no):
+    # run input_thread{t_no}.txt as VFMS_threaded.ScriptJob does, but with every
+    # command going through the router; a command that fails ends the script
+    with open(f"input_thread{t_no}.txt", "r") as fin:
+        script = VFMS_commands.parse_script(fin)
+    session = router.new_session()
+    with open(f"output_thread{t_no}.txt", "w") as fout:
+        for invocation in script:
+            try:
+                fout.write(router.execute(session, invocation))
+            except ShardError as error:
+                fout.write(VFMS_commands.internal_error(error))
+                break
+            if invocation[0] is not None and invocation[0].ends_session:
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run input_thread#.txt scripts against a sharded file system")
+    parser.add_argument('threads', type=int)
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--stats', action='store_true', help="collect counters in every shard for the stats command")
+    args = parser.parse_args(sys.argv[1:])
+    router = ShardRouter(args.shards, persist=True, stats=args.stats)
+    threads = [threading.Thread(target=terminal, args=(router, i + 1)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if args.stats:
+        VFMS_stats.dump("VFMS_stats.json", router.stats_snapshot())
+    router.close()
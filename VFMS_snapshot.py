@@ -0,0 +1,184 @@
+import os
+import mmap
+import struct
+
+# Versioned binary snapshot of a VirtualFileSystem.
+#
+#   header    magic, version, device geometry, flags, checkpoint lsn and the
+#             sizes of the two sections below
+#   metadata  one entry per directory or file in preorder: kind, parent entry,
+#             timestamps (microseconds since the epoch) and name; files also
+#             carry their size, where their bytes sit in the content section
+#             and the block runs they occupy on the device
+#   content   utf-8 file data back to back
+#
+# Loading only parses the metadata. The content section is memory mapped and
+# a file's bytes are decoded the first time something reads them.
+
+MAGIC = b'VFMS'
+VERSION = 2
+POLICIES = ('first', 'best')
+# blocks may be shared between files (saved with VFMS_dedup attached)
+SHARED_BLOCKS = 1
+
+HEADER = struct.Struct('<4sHBBQQQQQ')  # magic, version, policy, flags, num_blocks, block_size, lsn, metadata length, content length
+ENTRY = struct.Struct('<BIqqH')        # kind, parent, created, modified, name length
+FILE = struct.Struct('<QQQI')          # size, content offset, content length, runs
+RUN = struct.Struct('<QQH')            # first block, blocks, directory name length
+
+DIRECTORY, FILE_ENTRY = 0, 1
+
+
+def to_micros(ns):
+    return ns // 1000
+
+
+def from_micros(micros):
+    return micros * 1000
+
+
+class Source:
+    # where a not yet loaded file's bytes live inside a mapped snapshot
+    __slots__ = ('mapping', 'offset', 'length')
+    # reads decode the file for good, see VFMS_compress.Compressed
+    cached = False
+
+    def __init__(self, mapping, offset, length):
+        self.mapping = mapping
+        self.offset = offset
+        self.length = length
+
+    def raw(self):
+        return self.mapping[self.offset:self.offset + self.length]
+
+    def load(self):
+        return self.raw().decode('utf-8')
+
+
+def _pack_name(name):
+    return name.encode('utf-8')
+
+
+def _runs(vfs, _file):
+    # (start, length, directory name) runs of blocks sharing a map label
+    runs = []
+    for start, length in _file.extents:
+        for block in range(start, start + length):
+            dir_name = vfs.memory[block][2]
+            if runs and runs[-1][2] == dir_name and runs[-1][0] + runs[-1][1] == block:
+                runs[-1][1] += 1
+            else:
+                runs.append([block, 1, dir_name])
+    return runs
+
+
+def save(vfs, path, lsn=0):
+    meta = bytearray()
+    lazy = []
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        content_length = 0
+        # content goes straight after the header while metadata is built up in
+        # memory, then the metadata is appended and the header filled in
+        stack = [(vfs.root, 0)]
+        index = 0
+        while stack:
+            item, parent = stack.pop()
+            name = _pack_name(item.name)
+            if hasattr(item, 'contents'):
+                meta += ENTRY.pack(DIRECTORY, parent, to_micros(item.created_at), to_micros(item.modified_at), len(name)) + name
+                # reversed so children come off the stack in insertion order
+                stack.extend((child, index) for child in reversed(list(item.contents.values())))
+            else:
+                meta += ENTRY.pack(FILE_ENTRY, parent, to_micros(item.created_at), to_micros(item.modified_at), len(name)) + name
+                if item.source is not None:
+                    data = item.source.raw()
+                    lazy.append((item, content_length, len(data)))
+                else:
+                    data = item.data.encode()
+                runs = _runs(vfs, item)
+                meta += FILE.pack(item.size, content_length, len(data), len(runs))
+                for start, length, dir_name in runs:
+                    dir_name = _pack_name(dir_name)
+                    meta += RUN.pack(start, length, len(dir_name)) + dir_name
+                f.write(data)
+                content_length += len(data)
+            index += 1
+        f.write(meta)
+        f.seek(0)
+        flags = SHARED_BLOCKS if vfs.dedup is not None else 0
+        f.write(HEADER.pack(MAGIC, VERSION, POLICIES.index(vfs.allocator.policy), flags, vfs.allocator.num_blocks,
+                            vfs.block_size, lsn, len(meta), content_length))
+        f.flush()
+        os.fsync(f.fileno())
+    # files still backed by the old snapshot move over to the new one, which
+    # is mapped and in place before the old mapping goes away; if anything
+    # fails on the way the old mapping stays as it was
+    mapping = _map(tmp)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        mapping.close()
+        raise
+    old, vfs.snapshot = vfs.snapshot, mapping
+    for item, offset, length in lazy:
+        item.source = Source(mapping, HEADER.size + offset, length)
+    if old is not None:
+        old.close()
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def load(vfs, path, file_class, directory_class):
+    # replace the contents of vfs with the snapshot at path and return its lsn,
+    # or 0 when there is no snapshot yet
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+        return 0
+    mapping = _map(path)
+    magic, version, policy, flags, num_blocks, block_size, lsn, meta_length, content_length = HEADER.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a VFMS snapshot")
+    if version != VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+    if flags & SHARED_BLOCKS and vfs.dedup is None:
+        # files share blocks, which only VFMS_dedup can keep track of
+        raise ValueError(f"{path} was saved with block dedup on and can only be loaded with it on")
+    vfs.reset_device(num_blocks, POLICIES[policy], block_size)
+    vfs.snapshot = mapping
+    content = HEADER.size
+    pos = content + content_length
+    end = pos + meta_length
+    entries = []
+    while pos < end:
+        kind, parent, created, modified, name_length = ENTRY.unpack_from(mapping, pos)
+        pos += ENTRY.size
+        name = mapping[pos:pos + name_length].decode('utf-8')
+        pos += name_length
+        if kind == DIRECTORY:
+            item = directory_class(name)
+        else:
+            item = file_class(name)
+            size, offset, length, run_count = FILE.unpack_from(mapping, pos)
+            pos += FILE.size
+            item.size = size
+            if size:
+                item.source = Source(mapping, content + offset, length)
+            for _ in range(run_count):
+                start, blocks, dir_length = RUN.unpack_from(mapping, pos)
+                pos += RUN.size
+                dir_name = mapping[pos:pos + dir_length].decode('utf-8')
+                pos += dir_length
+                vfs.claim_blocks(item, start, blocks, dir_name)
+        item.created_at = from_micros(created)
+        item.modified_at = from_micros(modified)
+        if entries:
+            item.parent = entries[parent]
+            entries[parent].contents[name] = item
+        entries.append(item)
+    vfs.root = entries[0]
+    vfs.current_directory = vfs.root
+    return lsn
@@ -0,0 +1,360 @@
+import json
+import time
+import threading
+import collections
+from contextlib import contextmanager
+import VFMS_commands
+
+# Optional instrumentation for the virtual file system. Nothing here runs
+# unless install() is called: it wraps the command dispatcher, the hot
+# VirtualFileSystem methods, the allocator and OutputWriter in timing shims and
+# swaps every lock created from then on (and the shared lock stripes) for a
+# proxy measuring how long callers wait for it and hold it. uninstall() puts
+# the original functions back, so with instrumentation off the code paths are
+# exactly the uninstrumented ones.
+#
+# install() takes the namespace holding the classes (globals() of the module
+# that defines them) and has to run before the VirtualFileSystem is built, as
+# only locks created afterwards are measured.
+
+# VirtualFileSystem methods timed individually
+METHODS = ('create_file', 'delete_file', 'create_directory', 'delete_directory', 'resolve', 'change_directory',
+           'move_file', 'write_to_file', 'truncate_file', 'update_mmap', 'release_blocks')
+# free space samples kept for the trend
+TREND = 256
+
+
+class Histogram:
+    # latencies in power of two nanosecond buckets: bucket b holds values
+    # below 2**b ns
+    BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def record(self, ns):
+        bucket = min(ns.bit_length(), self.BUCKETS - 1)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += ns
+            if ns > self.max:
+                self.max = ns
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of samples
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= fraction * self.count:
+                return 1 << bucket
+        return 0
+
+    def as_dict(self):
+        return {'count': self.count, 'total_ns': self.total, 'max_ns': self.max,
+                'p50_ns': self.percentile(0.5), 'p99_ns': self.percentile(0.99),
+                'buckets': {f"<{1 << b}": c for b, c in enumerate(self.counts) if c}}
+
+
+class LockStats:
+    def __init__(self):
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.contended = 0
+
+
+class Registry:
+    def __init__(self):
+        self.commands = collections.defaultdict(Histogram)
+        self.methods = collections.defaultdict(Histogram)
+        self.locks = collections.defaultdict(LockStats)
+        self.allocated = 0
+        self.freed = 0
+        self.trend = collections.deque(maxlen=TREND)
+        self.started = time.monotonic()
+
+
+registry = None
+# (owner, attribute, original) for everything install() replaced
+_patched = []
+
+
+class TimedLock:
+    # stands in for a threading.Lock or RLock
+    def __init__(self, lock, stats):
+        self.lock = lock
+        self.stats = stats
+        # thread ident -> acquisition times, a stack because an RLock nests
+        self.held = {}
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter_ns()
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            self.stats.contended += 1
+            if not self.lock.acquire(True, timeout):
+                return False
+        now = time.perf_counter_ns()
+        self.stats.wait.record(now - start)
+        self.held.setdefault(threading.get_ident(), []).append(now)
+        return True
+
+    def release(self):
+        start = self.held[threading.get_ident()].pop()
+        self.lock.release()
+        self.stats.hold.record(time.perf_counter_ns() - start)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class TimedReadWriteLock:
+    # stands in for a ReadWriteLock, with reads and writes measured apart
+    def __init__(self, lock, read_stats, write_stats):
+        self.lock = lock
+        self.read_stats = read_stats
+        self.write_stats = write_stats
+        self.held = {}
+
+    def _timed(self, acquire, stats):
+        start = time.perf_counter_ns()
+        acquire()
+        now = time.perf_counter_ns()
+        stats.wait.record(now - start)
+        self.held.setdefault(threading.get_ident(), []).append(now)
+
+    def _release(self, release, stats):
+        start = self.held[threading.get_ident()].pop()
+        release()
+        stats.hold.record(time.perf_counter_ns() - start)
+
+    def acquire_read(self):
+        self._timed(self.lock.acquire_read, self.read_stats)
+
+    def release_read(self):
+        self._release(self.lock.release_read, self.read_stats)
+
+    def acquire_write(self):
+        self._timed(self.lock.acquire_write, self.write_stats)
+
+    def release_write(self):
+        self._release(self.lock.release_write, self.write_stats)
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def _patch(owner, attribute, replacement):
+    _patched.append((owner, attribute, getattr(owner, attribute)))
+    setattr(owner, attribute, replacement)
+
+
+def _timed(histogram, function):
+    def timed(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+    return timed
+
+
+def _timed_locks(cls, attribute, name):
+    # make every new cls instance swap attribute for a timed proxy
+    original = cls.__init__
+
+    def __init__(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        lock = getattr(self, attribute)
+        if hasattr(lock, 'acquire_read'):
+            setattr(self, attribute, TimedReadWriteLock(lock, registry.locks[name + '(read)'],
+                                                        registry.locks[name + '(write)']))
+        else:
+            setattr(self, attribute, TimedLock(lock, registry.locks[name]))
+    _patch(cls, '__init__', __init__)
+
+
+def install(namespace):
+    global registry
+    if registry is not None:
+        return
+    registry = Registry()
+    vfs_class = namespace['VirtualFileSystem']
+    allocator = namespace['BlockAllocator']
+
+    original_execute = VFMS_commands.execute
+
+    def execute(vfs, session, invocation):
+        start = time.perf_counter_ns()
+        try:
+            return original_execute(vfs, session, invocation)
+        finally:
+            name = invocation[0].name if invocation[0] is not None else 'invalid'
+            registry.commands[name].record(time.perf_counter_ns() - start)
+    _patch(VFMS_commands, 'execute', execute)
+
+    for method in METHODS:
+        _patch(vfs_class, method, _timed(registry.methods['VirtualFileSystem.' + method], getattr(vfs_class, method)))
+    writer = namespace['OutputWriter']
+    _patch(writer, 'write', _timed(registry.methods['OutputWriter.write'], writer.write))
+    _patch(writer, 'flush', _timed(registry.methods['OutputWriter.flush'], writer.flush))
+
+    _timed_locks(namespace['Directory'], 'lock', 'Directory.lock')
+    _timed_locks(namespace['File'], 'lock', 'File.lock')
+    _timed_locks(allocator, 'lock', 'BlockAllocator.lock')
+
+    allocate, release, claim = allocator.allocate, allocator.release, allocator.claim
+
+    def sample(free):
+        registry.trend.append((round(time.monotonic() - registry.started, 6), free))
+
+    def allocate_(self, count):
+        extents = allocate(self, count)
+        if extents:
+            registry.allocated += sum(length for _, length in extents)
+            sample(self.free)
+        return extents
+
+    def release_(self, start, length):
+        release(self, start, length)
+        registry.freed += length
+        sample(self.free)
+
+    def claim_(self, start, length):
+        claim(self, start, length)
+        registry.allocated += length
+        sample(self.free)
+    _patch(allocator, 'allocate', allocate_)
+    _patch(allocator, 'release', release_)
+    _patch(allocator, 'claim', claim_)
+
+
+def uninstall():
+    global registry
+    while _patched:
+        owner, attribute, original = _patched.pop()
+        setattr(owner, attribute, original)
+    registry = None
+
+
+def snapshot():
+    # everything collected so far as plain data, or None when not installed
+    if registry is None:
+        return None
+    return {
+        'uptime_sec': time.monotonic() - registry.started,
+        'commands': {name: h.as_dict() for name, h in registry.commands.items()},
+        'methods': {name: h.as_dict() for name, h in registry.methods.items()},
+        'locks': {name: {'contended': s.contended, 'wait': s.wait.as_dict(), 'hold': s.hold.as_dict()}
+                  for name, s in registry.locks.items()},
+        'allocator': {'allocated_blocks': registry.allocated, 'freed_blocks': registry.freed,
+                      'free_trend': list(registry.trend)},
+    }
+
+
+def _merge_histograms(histograms):
+    buckets = collections.Counter()
+    for h in histograms:
+        buckets.update(h['buckets'])
+    count = sum(h['count'] for h in histograms)
+    ordered = sorted(buckets.items(), key=lambda item: int(item[0][1:]))
+
+    def percentile(fraction):
+        seen = 0
+        for bound, c in ordered:
+            seen += c
+            if seen >= fraction * count:
+                return int(bound[1:])
+        return 0
+    return {'count': count, 'total_ns': sum(h['total_ns'] for h in histograms),
+            'max_ns': max((h['max_ns'] for h in histograms), default=0),
+            'p50_ns': percentile(0.5), 'p99_ns': percentile(0.99), 'buckets': dict(ordered)}
+
+
+def _merge_group(groups, merge_one):
+    names = {}
+    for group in groups:
+        for name, value in group.items():
+            names.setdefault(name, []).append(value)
+    return {name: merge_one(values) for name, values in names.items()}
+
+
+def merge(snapshots):
+    # one snapshot adding up several taken apart, such as one per shard;
+    # those that are None are left out. The free space trend becomes a single
+    # sample of the free blocks left everywhere
+    snapshots = [s for s in snapshots if s is not None]
+    if not snapshots:
+        return None
+    trends = [s['allocator']['free_trend'] for s in snapshots]
+    uptime = max(s['uptime_sec'] for s in snapshots)
+    return {
+        'uptime_sec': uptime,
+        'commands': _merge_group([s['commands'] for s in snapshots], _merge_histograms),
+        'methods': _merge_group([s['methods'] for s in snapshots], _merge_histograms),
+        'locks': _merge_group([s['locks'] for s in snapshots], lambda locks: {
+            'contended': sum(lock['contended'] for lock in locks),
+            'wait': _merge_histograms([lock['wait'] for lock in locks]),
+            'hold': _merge_histograms([lock['hold'] for lock in locks])}),
+        'allocator': {'allocated_blocks': sum(s['allocator']['allocated_blocks'] for s in snapshots),
+                      'freed_blocks': sum(s['allocator']['freed_blocks'] for s in snapshots),
+                      'free_trend': [[round(uptime, 6), sum(t[-1][1] for t in trends)]] if all(trends) else []},
+    }
+
+
+def dump(path, data=None):
+    # data defaults to what this process collected
+    with open(path, 'w') as f:
+        json.dump(snapshot() if data is None else data, f, indent=2)
+
+
+def _us(ns):
+    return f"{ns / 1000:.1f}"
+
+
+def report(data=None):
+    # text form of a snapshot, by default of what this process collected
+    if data is None:
+        data = snapshot()
+    if data is None:
+        return "\nInstrumentation is off"
+    out = [f"\n{'timer':36} {'count':>8} {'mean(us)':>10} {'p50(us)':>9} {'p99(us)':>9}"]
+    for group in (data['commands'], data['methods']):
+        for name, h in sorted(group.items()):
+            if h['count']:
+                out.append(f"\n{name:36} {h['count']:>8} {_us(h['total_ns'] / h['count']):>10} "
+                           f"{_us(h['p50_ns']):>9} {_us(h['p99_ns']):>9}")
+    out.append(f"\n\n{'lock':36} {'acquired':>8} {'contended':>10} {'wait(us)':>9} {'hold(us)':>9}")
+    for name, s in sorted(data['locks'].items()):
+        if s['hold']['count']:
+            out.append(f"\n{name:36} {s['hold']['count']:>8} {s['contended']:>10} "
+                       f"{_us(s['wait']['total_ns']):>9} {_us(s['hold']['total_ns']):>9}")
+    allocator = data['allocator']
+    trend = allocator['free_trend']
+    free = trend[-1][1] if trend else '-'
+    lowest = min(f for _, f in trend) if trend else '-'
+    out.append(f"\n\nblocks allocated {allocator['allocated_blocks']}, freed {allocator['freed_blocks']}, "
+               f"free {free} (lowest {lowest})")
+    return ''.join(out)
@@ -0,0 +1,279 @@
+import os
+import random
+import tempfile
+import unittest
+import VFMS_commands
+from VFMS_threaded import VirtualFileSystem, File, ChunkedContent, ByteContent, BlockAllocator
+from VFMS_wal import WriteAheadLog, recover, checkpoint
+from VFMS_textindex import TextIndex
+from VFMS_dedup import Dedup
+from VFMS_pagecache import PageCache
+
+# Regression tests, run with python -m unittest VFMS_test (or pytest).
+
+
+class ChunkedContentTest(unittest.TestCase):
+    def check(self, content_class):
+        # random appends, inserts and truncates against a plain string
+        rng = random.Random(1)
+        content, expected = content_class(), ''
+        for _ in range(2000):
+            op = rng.random()
+            if op < 0.3:
+                data = 'x' * rng.randint(0, 300)
+                content.append(data)
+                expected += data
+            elif op < 0.8:
+                offset = rng.randint(0, len(expected))
+                data = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 50)))
+                content.insert(offset, data)
+                expected = expected[:offset] + data + expected[offset:]
+            elif op < 0.85:
+                size = rng.randint(0, len(expected))
+                content.truncate(size)
+                expected = expected[:size]
+            else:
+                offset, length = rng.randint(0, len(expected)), rng.randint(1, 200)
+                self.assertEqual(content.text_at(offset, length), expected[offset:offset+length])
+            self.assertEqual(len(content), len(expected))
+        self.assertEqual(str(content), expected)
+
+    def test_matches_string(self):
+        self.check(ChunkedContent)
+
+    def test_bytes_match_string(self):
+        self.check(ByteContent)
+
+    def test_inserts_at_one_spot_stay_in_few_chunks(self):
+        size = ChunkedContent.CHUNK_SIZE
+        for offset in (0, 50000):
+            content = ChunkedContent('a' * 100000)
+            for _ in range(16000):
+                content.insert(offset, 'b')
+            # chunks hold at least two thirds of CHUNK_SIZE, the last aside
+            self.assertLessEqual(len(content.chunks), len(content) * 3 // (2 * size) + 1)
+
+
+class BlockAllocatorTest(unittest.TestCase):
+    def check(self, policy):
+        # random allocations and releases against a map of the free blocks
+        rng = random.Random(2)
+        allocator, free, held = BlockAllocator(1000, policy), [True] * 1000, []
+        for _ in range(3000):
+            if rng.random() < 0.5 or not held:
+                count = rng.randint(1, 20)
+                extents = allocator.allocate(count)
+                if extents is None:
+                    self.assertGreater(count, sum(free))
+                    continue
+                self.assertEqual(sum(length for _, length in extents), count)
+                if len(extents) > 1:
+                    # split only when no single free extent was long enough
+                    self.assertNotIn('.' * count, ''.join('.' if f else 'x' for f in free))
+                for start, length in extents:
+                    self.assertTrue(all(free[start:start + length]))
+                    free[start:start + length] = [False] * length
+                held += extents
+            else:
+                start, length = held.pop(rng.randrange(len(held)))
+                allocator.release(start, length)
+                free[start:start + length] = [True] * length
+            self.assertEqual(allocator.free, sum(free))
+        # coalesced: every free run is one extent
+        runs = ''.join('.' if f else 'x' for f in free).split('x')
+        self.assertEqual(sorted(allocator.lengths.values()), sorted(len(run) for run in runs if run))
+
+    def test_first_fit(self):
+        self.check('first')
+
+    def test_best_fit(self):
+        self.check('best')
+
+    def test_first_fit_takes_lowest_extent_with_room(self):
+        allocator = BlockAllocator(4000)
+        allocator.allocate(4000)
+        for start in range(0, 3000, 4):
+            allocator.release(start, 2)
+        allocator.release(3500, 5)
+        allocator.release(3200, 3)
+        self.assertEqual(allocator.allocate(3), [(3200, 3)])
+        self.assertEqual(allocator.allocate(2), [(0, 2)])
+        with self.assertRaises(ValueError):
+            allocator.claim(4, 3)
+
+
+def churn(vfs, session, rng, steps):
+    # random commands over a few names in two directory levels, as a script
+    # would run them
+    for _ in range(steps):
+        name = f"f{rng.randint(0, 5)}.txt"
+        data = ''.join(rng.choice('abcé') for _ in range(rng.randint(1, 40)))
+        size = vfs.size_of(session.current_directory.get_file(name) or File(name))
+        line = rng.choice([
+            f"create {name}", f"create {name}", f"delete {name}", f"mkdir d{rng.randint(0, 2)}",
+            f"rmdir d{rng.randint(0, 2)}", f"chdir d{rng.randint(0, 2)}", "chdir /", "chdir ..",
+            f"move {name} /d{rng.randint(0, 2)}", f"move {name} /", f"truncate {name} {rng.randint(-1, size + 2)}",
+            f"open {name} w", f"open {name} w", f"close {name}",
+        ] + [
+            f"write_to_file {name} {data}", f"write_to_file {name} {data} {rng.randint(-1, size + 2)}",
+        ] * 4)
+        VFMS_commands.execute(vfs, session, VFMS_commands.parse(line))
+    session.close_all()
+
+
+def tree(vfs):
+    # path -> content as stored for files, None for directories
+    out = {}
+    stack = [vfs.root]
+    while stack:
+        directory = stack.pop()
+        for item in directory.contents.values():
+            if isinstance(item, File):
+                out[item.path()] = item.readable.native()
+            else:
+                out[item.path()] = None
+                stack.append(item)
+    return out
+
+
+def storages(test):
+    # runs the loop body once with text and once with byte storage
+    for content_class in (ChunkedContent, ByteContent):
+        File.content_class = content_class
+        try:
+            with test.subTest(storage=content_class.__name__):
+                yield
+        finally:
+            File.content_class = ChunkedContent
+
+
+class TextIndexTest(unittest.TestCase):
+    def test_matches_rebuild_and_brute_force(self):
+        for _ in storages(self):
+            rng = random.Random(3)
+            vfs = VirtualFileSystem(100000)
+            vfs.text_index = TextIndex(1 << 30)
+            session = vfs.new_session()
+            for _ in range(20):
+                churn(vfs, session, rng, 50)
+                files = list(vfs.files(vfs.root))
+                rebuilt = TextIndex(1 << 30)
+                for _file in files:
+                    rebuilt.add(_file)
+                self.assertEqual(vfs.text_index.postings, rebuilt.postings)
+                for _ in range(20):
+                    text = ''.join(rng.choice('abcé') for _ in range(rng.randint(1, 5)))
+                    needle = File.content_class.coerce(text)
+                    expected = {f for f in files if needle in f.readable.native()}
+                    self.assertEqual(set(vfs.grep(text, '/')), expected)
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def test_recover_replays_the_tree(self):
+        for _ in storages(self):
+            rng = random.Random(4)
+            with tempfile.TemporaryDirectory() as tmp:
+                log, ckpt = os.path.join(tmp, 'VFMS.log'), os.path.join(tmp, 'VFMS.ckpt')
+                vfs = VirtualFileSystem(100000)
+                vfs.wal = WriteAheadLog(log)
+                session = vfs.new_session()
+                churn(vfs, session, rng, 300)
+                checkpoint(vfs, ckpt, vfs.wal)
+                churn(vfs, session, rng, 300)
+                vfs.wal.close()
+                restored = VirtualFileSystem()
+                recover(restored, ckpt, log)
+                self.assertEqual(tree(restored), tree(vfs))
+                self.assertEqual(restored.allocator.free, vfs.allocator.free)
+
+    def test_binary_data_survives(self):
+        data = bytes(range(256))
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'VFMS.log')
+            File.content_class = ByteContent
+            try:
+                vfs = VirtualFileSystem(4096)
+                vfs.wal = WriteAheadLog(log)
+                vfs.create_file('bin')
+                _file = vfs.root.get_file('bin')
+                _file.open('w')
+                vfs.write_to_file(_file, data)
+                _file.close()
+                vfs.wal.close()
+                restored = VirtualFileSystem(4096)
+                recover(restored, os.path.join(tmp, 'none'), log)
+                self.assertEqual(restored.root.get_file('bin').readable.native(), data)
+            finally:
+                File.content_class = ChunkedContent
+            # text storage takes it as importing it would
+            restored = VirtualFileSystem(4096)
+            recover(restored, os.path.join(tmp, 'none'), log)
+            self.assertEqual(restored.root.get_file('bin').readable.native(), data.decode('utf-8', 'replace'))
+
+    def test_record_in_a_removed_directory_is_skipped(self):
+        for _ in storages(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                log = os.path.join(tmp, 'VFMS.log')
+                wal = WriteAheadLog(log)
+                wal.append('create', path='/x.txt')
+                wal.append('mkdir', path='/gone')
+                wal.append('create', path='/gone/x.txt')
+                wal.append('rmdir', path='/gone')
+                wal.append('write', path='/gone/x.txt', data='LATE')
+                wal.close()
+                restored = VirtualFileSystem()
+                recover(restored, os.path.join(tmp, 'none'), log)
+                self.assertEqual(tree(restored), {'/x.txt': File.content_class.EMPTY})
+
+
+class DedupTest(unittest.TestCase):
+    def check_refs(self, vfs):
+        # every mapped logical block is a reference to its physical block and
+        # every physical block in use is out of the allocator
+        refs = {}
+        for _file in vfs.files(vfs.root):
+            self.assertEqual(_file.blocks, vfs.blocks_needed(_file.size))
+            blocks = [block for start, length in _file.block_extents(0, _file.blocks)
+                      for block in range(start, start + length)]
+            for index, block in enumerate(blocks):
+                refs.setdefault(block, set()).add((_file, index))
+        self.assertEqual({block: set(users) for block, users in vfs.dedup.refs.items()}, refs)
+        self.assertEqual(vfs.allocator.free + len(refs), vfs.allocator.num_blocks)
+
+    def test_refcounts_and_snapshot(self):
+        for _ in storages(self):
+            rng = random.Random(5)
+            vfs = VirtualFileSystem(100000, block_size=4)
+            vfs.dedup = Dedup()
+            session = vfs.new_session()
+            churn(vfs, session, rng, 600)
+            self.check_refs(vfs)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'VFMS.ckpt')
+                vfs.save_snapshot(path)
+                with self.assertRaises(ValueError):
+                    VirtualFileSystem().load_snapshot(path)
+                restored = VirtualFileSystem()
+                restored.dedup = Dedup()
+                restored.load_snapshot(path)
+                self.assertEqual(tree(restored), tree(vfs))
+                self.check_refs(restored)
+                restored.snapshot.close()
+                vfs.snapshot.close()
+
+
+class PageCacheTest(unittest.TestCase):
+    def test_same_tree_as_without(self):
+        for _ in storages(self):
+            for policy in ('lru', 'clock', '2q'):
+                plain, cached = VirtualFileSystem(100000), VirtualFileSystem(100000)
+                cached.page_cache = PageCache(cached, 8, policy, 16)
+                for vfs in (plain, cached):
+                    churn(vfs, vfs.new_session(), random.Random(6), 600)
+                cached.settle()
+                self.assertEqual(tree(cached), tree(plain))
+                self.assertEqual(cached.allocator.free, plain.allocator.free)
+
+
+if __name__ == '__main__':
+    unittest.main()
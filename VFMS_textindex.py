@@ -0,0 +1,166 @@
+import threading
+import collections
+
+# Optional trigram index over file contents, used by the grep command to pick
+# the files that can contain a string before reading any of them.
+#
+# Every three character substring of an indexed file maps to the files holding
+# it and how often. Changes only touch the trigrams around the edit: an append
+# adds the ones reaching back two characters into the old end, an insert
+# replaces the ones spanning the insertion point and a truncate drops the ones
+# reaching past the new end.
+#
+# The index estimates its own size and never grows past max_bytes: a file
+# whose trigrams don't fit is left out and goes on an unindexed set that grep
+# searches directly, so results stay exact. Files restored from a snapshot
+# start out unindexed too, since indexing them would mean decoding every one of
+# them up front, and get indexed the first time grep reads them.
+#
+# Trigrams are taken over the content as stored, so with byte storage they are
+# runs of three utf-8 bytes and grep looks up the encoded search text.
+
+# rough cost of one (trigram, file) posting and of one distinct trigram
+POSTING_BYTES = 100
+TRIGRAM_BYTES = 250
+
+
+def trigrams(text):
+    return collections.Counter(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TextIndex:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.postings = {}
+        self.pairs = 0
+        self.unindexed = set()
+        self.lock = threading.Lock()
+        # edits of one file are serialised on one of these, picked by identity
+        self.stripes = tuple(threading.Lock() for _ in range(64))
+
+    def stripe(self, _file):
+        return self.stripes[(id(_file) >> 4) % len(self.stripes)]
+
+    def size(self):
+        return self.pairs * POSTING_BYTES + len(self.postings) * TRIGRAM_BYTES
+
+    def _apply(self, _file, removed, added):
+        # returns False, changing nothing, when the additions don't fit
+        with self.lock:
+            new_pairs = sum(1 for t in added if _file not in self.postings.get(t, ()))
+            new_trigrams = sum(1 for t in added if t not in self.postings)
+            if self.size() + new_pairs * POSTING_BYTES + new_trigrams * TRIGRAM_BYTES > self.max_bytes:
+                return False
+            for t, count in removed.items():
+                files = self.postings.get(t)
+                if files is None or _file not in files:
+                    continue
+                files[_file] -= count
+                if files[_file] <= 0:
+                    del files[_file]
+                    self.pairs -= 1
+                    if not files:
+                        del self.postings[t]
+            for t, count in added.items():
+                files = self.postings.setdefault(t, {})
+                if _file not in files:
+                    files[_file] = 0
+                    self.pairs += 1
+                files[_file] += count
+            return True
+
+    def _drop(self, _file, indexed):
+        # forget the file, whose postings are the counts in indexed, and
+        # search it directly from now on
+        self._apply(_file, +indexed, {})
+        self.unindexed.add(_file)
+
+    def add(self, _file):
+        # a file joining the tree, possibly with content already
+        with self.stripe(_file):
+            if _file.size and not self._apply(_file, {}, trigrams(_file.readable.native())):
+                self.unindexed.add(_file)
+
+    def remove(self, _file):
+        with self.stripe(_file):
+            if _file in self.unindexed:
+                self.unindexed.discard(_file)
+            elif _file.size:
+                self._apply(_file, trigrams(_file.readable.native()), {})
+
+    def write(self, _file, offset, data, apply):
+        # run apply(), the write of data at offset (None to append), keeping
+        # the file's trigrams up to date
+        with self.stripe(_file):
+            if _file.deleted or _file in self.unindexed:
+                return apply()
+            content = _file.data
+            before = len(content)
+            at = before if offset is None else offset
+            if not 0 <= at <= before:
+                # apply() turns the offset down without changing anything
+                return apply()
+            left = content.slice(max(0, at - 2), min(at, 2))
+            right = content.slice(at, 2)
+            result = apply()
+            if _file.size != before:
+                data = content.coerce(data)
+                removed, added = trigrams(left + right), trigrams(left + data + right)
+                if not self._apply(_file, removed, added):
+                    # the postings still describe the content before the write
+                    indexed = trigrams(content.native())
+                    indexed.subtract(added)
+                    indexed.update(removed)
+                    self._drop(_file, indexed)
+            return result
+
+    def truncate(self, _file, size, apply):
+        with self.stripe(_file):
+            if _file.deleted or _file in self.unindexed:
+                return apply()
+            content = _file.data
+            before = len(content)
+            if size is not None and not 0 <= size <= before:
+                return apply()
+            start = max(0, (size or 0) - 2)
+            tail = content.slice(start, before - start)
+            result = apply()
+            if _file.size != before:
+                self._apply(_file, trigrams(tail), {})
+            return result
+
+    def reset(self, files):
+        # start over after the tree was replaced, with files unindexed
+        with self.lock:
+            self.postings.clear()
+            self.pairs = 0
+            self.unindexed = set(files)
+
+    def candidates(self, text):
+        # indexed files that hold every trigram of text, None when text is too
+        # short to narrow anything down
+        if len(text) < 3:
+            return None
+        with self.lock:
+            sets = []
+            for t in trigrams(text):
+                files = self.postings.get(t)
+                if not files:
+                    return set()
+                sets.append(files)
+            sets.sort(key=len)
+            found = set(sets[0])
+            for files in sets[1:]:
+                found.intersection_update(files)
+            return found
+
+    def index_unindexed(self, _file):
+        # called by grep once it has read an unindexed file anyway
+        with self.stripe(_file):
+            if _file in self.unindexed and not _file.deleted:
+                if self._apply(_file, {}, trigrams(_file.readable.native())):
+                    self.unindexed.discard(_file)
+
+    def report(self):
+        return (f"\ntext index: {len(self.postings)} trigrams, {self.pairs} postings, "
+                f"~{self.size() // 1024} KiB of {self.max_bytes // 1024} KiB, {len(self.unindexed)} files unindexed")
@@ -1,26 +1,457 @@
-import datetime
 import threading
+import bisect
+import fnmatch
+import time
+import codecs
+import collections
+from contextlib import contextmanager
 import sys
-import builtins
-from unittest.mock import patch
-import json
-import jsonpickle
+from VFMS_wal import WriteAheadLog, recover, checkpoint
+import VFMS_snapshot
+import VFMS_host
+import VFMS_commands
+import VFMS_stats
+from VFMS_textindex import TextIndex
+from VFMS_dedup import Dedup
+from VFMS_compress import Compressor
+from VFMS_pagecache import PageCache
+
+class ReadWriteLock:
+    # shared lock for readers, exclusive for writers; once a writer is waiting
+    # new readers queue behind it so a steady stream of reads can't starve it
+    __slots__ = ('cond', 'readers', 'writer', 'waiting_writers')
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class ContentStream:
+    # A file's content as it was when the stream was taken, handed out in
+    # pieces of at most chunk_size. Chunks are always replaced, never changed
+    # in place, so holding on to the list keeps the snapshot intact without
+    # copying any data and later writes don't show through.
+    __slots__ = ('chunks', 'chunk_size', 'binary', 'length')
+
+    def __init__(self, chunks, chunk_size, binary):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        # pieces are memoryviews of utf-8 bytes rather than str
+        self.binary = binary
+        self.length = sum(map(len, chunks))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        size = self.chunk_size
+        for chunk in self.chunks:
+            view = memoryview(chunk) if self.binary else chunk
+            for i in range(0, len(chunk), size):
+                yield view[i:i+size]
+
+    def text(self):
+        # the pieces as str; a character split across two pieces is decoded
+        # once both are in
+        if not self.binary:
+            yield from self
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for piece in self:
+            text = decoder.decode(piece)
+            if text:
+                yield text
+        tail = decoder.decode(b'', True)
+        if tail:
+            yield tail
+
+    def encoded(self):
+        # the pieces as utf-8 bytes-like objects
+        for piece in self:
+            yield piece if self.binary else piece.encode('utf-8')
+
+    def encoded_length(self):
+        # bytes encoded() yields in all, counted a piece at a time
+        if self.binary:
+            return self.length
+        return sum(len(piece) for piece in self.encoded())
+
+    def __str__(self):
+        return ''.join(self.text())
+
+class ChunkedContent:
+    # File data kept as a list of chunks, so appends and inserts only copy the
+    # chunk they land in instead of the file. Appends fill chunks up to
+    # CHUNK_SIZE characters. An insert grows the chunk it lands in and only
+    # once that passes twice CHUNK_SIZE is it split into even pieces, so no
+    # chunk but the last drops below two thirds of CHUNK_SIZE and inserts at
+    # one spot don't fragment the list. Chunk offsets come from a Fenwick tree
+    # of chunk lengths, which appends and inserts update and lookups search in
+    # O(log chunks); only a split rebuilds it.
+    CHUNK_SIZE = 4096
+    EMPTY = ''
+    __slots__ = ('chunks', 'tree', 'length')
+
+    def __init__(self, data=''):
+        self.chunks = []
+        # tree[i] is the length of chunks[i - (i & -i)] .. chunks[i - 1]
+        self.tree = [0]
+        self.length = 0
+        if data:
+            self.append(data)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.native()
+
+    @classmethod
+    def restore(cls, source):
+        # content of a file still held by a VFMS_snapshot.Source
+        return cls(source.load())
+
+    @staticmethod
+    def coerce(data):
+        # data as stored in chunks
+        return data
+
+    def native(self):
+        # the whole content as stored: str here, bytes for ByteContent
+        return self.EMPTY.join(self.chunks)
+
+    def encode(self):
+        return self.native().encode('utf-8')
+
+    def slice(self, offset, length):
+        # a copy of part of the content as stored
+        return self.read_at(offset, length)
+
+    def text_at(self, offset, length):
+        return self.read_at(offset, length)
+
+    def stream(self, chunk_size):
+        return ContentStream(list(self.chunks), chunk_size, False)
+
+    def _split(self, data):
+        size = self.CHUNK_SIZE
+        return [data[i:i+size] for i in range(0, len(data), size)]
+
+    def _split_even(self, data):
+        # data in as few pieces of at most CHUNK_SIZE as it takes, all of about
+        # the same length
+        pieces = -(-len(data) // self.CHUNK_SIZE)
+        size = -(-len(data) // pieces)
+        return [data[i:i+size] for i in range(0, len(data), size)]
+
+    def _rebuild(self):
+        tree = [0]
+        tree.extend(map(len, self.chunks))
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def _grow(self, i, delta):
+        # chunks[i] changed length by delta
+        tree = self.tree
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _push(self, chunk):
+        # chunk was added at the end of self.chunks
+        tree = self.tree
+        i = len(tree)
+        total = len(chunk)
+        j = i - 1
+        while j > i - (i & -i):
+            total += tree[j]
+            j -= j & -j
+        tree.append(total)
+
+    def _locate(self, offset):
+        # (index, file offset) of the chunk holding offset (offset < self.length)
+        tree = self.tree
+        i = start = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            j = i + step
+            if j < len(tree) and start + tree[j] <= offset:
+                i = j
+                start += tree[j]
+            step >>= 1
+        return i, start
+
+    def append(self, data):
+        if not data:
+            return
+        if self.chunks and len(self.chunks[-1]) < self.CHUNK_SIZE:
+            piece = data[:self.CHUNK_SIZE - len(self.chunks[-1])]
+            self.chunks[-1] += piece
+            self._grow(len(self.chunks) - 1, len(piece))
+            self.length += len(piece)
+            data = data[len(piece):]
+        for chunk in self._split(data):
+            self.chunks.append(chunk)
+            self._push(chunk)
+            self.length += len(chunk)
+
+    def insert(self, offset, data):
+        if offset == self.length:
+            return self.append(data)
+        if not data:
+            return
+        i, start = self._locate(offset)
+        chunk = self.chunks[i]
+        local = offset - start
+        chunk = chunk[:local] + data + chunk[local:]
+        self.length += len(data)
+        if len(chunk) <= 2 * self.CHUNK_SIZE:
+            self.chunks[i] = chunk
+            self._grow(i, len(data))
+        else:
+            self.chunks[i:i+1] = self._split_even(chunk)
+            self._rebuild()
+
+    def read_at(self, offset, length):
+        if length <= 0 or offset >= self.length:
+            return self.EMPTY
+        i, start = self._locate(offset)
+        local = offset - start
+        parts = []
+        while length > 0 and i < len(self.chunks):
+            piece = self.chunks[i][local:local+length]
+            parts.append(piece)
+            length -= len(piece)
+            local = 0
+            i += 1
+        return self.EMPTY.join(parts)
+
+    def truncate(self, size):
+        if size >= self.length:
+            return
+        if size == 0:
+            self.chunks, self.tree = [], [0]
+        else:
+            i, start = self._locate(size)
+            local = size - start
+            del self.chunks[i+1:]
+            # entries up to i only cover chunks that are kept
+            del self.tree[i+2:]
+            if local:
+                self._grow(i, local - len(self.chunks[i]))
+                self.chunks[i] = self.chunks[i][:local]
+            else:
+                del self.chunks[i]
+                del self.tree[i+1]
+        self.length = size
+
+class ByteContent(ChunkedContent):
+    # ChunkedContent over utf-8 bytes instead of str, picked with STORAGE.
+    # Offsets and sizes count bytes. read_at hands out a memoryview into the
+    # chunk holding the range, copying only when the range spans chunks, and
+    # since chunks are immutable bytes a view stays valid after later writes.
+    # Text passed in is encoded on the way in.
+    EMPTY = b''
+    __slots__ = ()
+
+    def __init__(self, data=b''):
+        super().__init__(self.coerce(data))
+
+    @classmethod
+    def restore(cls, source):
+        # the snapshot already holds utf-8, so there is nothing to decode
+        return cls(source.raw())
+
+    @staticmethod
+    def coerce(data):
+        return data.encode('utf-8') if isinstance(data, str) else bytes(data)
+
+    def __str__(self):
+        return self.native().decode('utf-8', 'replace')
+
+    def encode(self):
+        return self.native()
+
+    def append(self, data):
+        super().append(self.coerce(data))
+
+    def insert(self, offset, data):
+        super().insert(offset, self.coerce(data))
+
+    def read_at(self, offset, length):
+        if length <= 0 or offset >= self.length:
+            return memoryview(self.EMPTY)
+        i, start = self._locate(offset)
+        local = offset - start
+        chunk = self.chunks[i]
+        if local + length <= len(chunk):
+            return memoryview(chunk)[local:local+length]
+        return memoryview(super().read_at(offset, length))
+
+    def slice(self, offset, length):
+        return bytes(self.read_at(offset, length))
+
+    def text_at(self, offset, length):
+        return str(self.read_at(offset, length), 'utf-8', 'replace')
+
+    def stream(self, chunk_size):
+        return ContentStream(list(self.chunks), chunk_size, True)
 
 class File:
+    # Metadata is kept small since a tree may hold millions of files: slots
+    # instead of a __dict__, timestamps as integer nanoseconds since the epoch
+    # (only formatted when listed), the type derived from the name on demand,
+    # and the content, lock and extent lists only created once needed.
+    # Budget for an empty file, name excluded: MEMORY_BUDGET bytes including
+    # its slot in the parent's contents and its NameIndex entries (see
+    # VFMS_bench.py entry_memory).
+    MEMORY_BUDGET = 384
+    # ChunkedContent, or ByteContent when STORAGE is 'bytes'
+    content_class = ChunkedContent
+    # guards decoding the contents of files restored from a snapshot and
+    # creating the content and lock of files that had none yet
+    load_lock = threading.Lock()
+    __slots__ = ('name', '_data', 'source', 'size', 'created_at', 'modified_at', 'accessed_at', 'open_mode',
+                 'parent', 'deleted', '_lock', 'extents', 'extent_index', 'blocks')
+
     def __init__(self, name, content=''):
         self.name = name
-        self.type = self.name.partition(".")[2]
-        self.content = content
-        self.size = len(content)
-        self.created_at = datetime.datetime.now()
+        self._data = self.content_class(content) if content else None
+        # VFMS_snapshot.Source or VFMS_compress.Compressed holding contents
+        # not decoded yet, if any
+        self.source = None
+        self.size = len(self._data) if content else 0
+        self.created_at = time.time_ns()
         self.modified_at = self.created_at
+        # last read or write, for VFMS_compress
+        self.accessed_at = self.created_at
         self.open_mode = None
-        self.lock = threading.Lock()
+        self.parent = None
+        self.deleted = False
+        self._lock = None
+        # physical extents (start, length) holding this file's blocks in
+        # logical order, and the logical block index each extent begins at;
+        # shared empty tuples until the first block is mapped
+        self.extents = ()
+        self.extent_index = ()
+        self.blocks = 0
+
+    @property
+    def type(self):
+        return self.name.partition(".")[2]
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            with File.load_lock:
+                if self._lock is None:
+                    self._lock = ReadWriteLock()
+        return self._lock
+
+    @lock.setter
+    def lock(self, lock):
+        self._lock = lock
+
+    def add_extents(self, extents):
+        if not self.extents:
+            self.extents, self.extent_index = [], []
+        for start, length in extents:
+            if self.extents and self.extents[-1][0] + self.extents[-1][1] == start:
+                # continues the last extent on the device
+                self.extents[-1] = (self.extents[-1][0], self.extents[-1][1] + length)
+            else:
+                self.extent_index.append(self.blocks)
+                self.extents.append((start, length))
+            self.blocks += length
+
+    def drop_blocks(self, count):
+        # detach the last count blocks and return the extents they occupied
+        freed = []
+        while count and self.extents:
+            start, length = self.extents[-1]
+            take = min(count, length)
+            if take == length:
+                self.extents.pop()
+                self.extent_index.pop()
+            else:
+                self.extents[-1] = (start, length - take)
+            freed.append((start + length - take, take))
+            self.blocks -= take
+            count -= take
+        return freed
+
+    def block_extents(self, first, count):
+        # physical extents holding logical blocks first .. first+count-1
+        result = []
+        i = bisect.bisect_right(self.extent_index, first) - 1
+        while count > 0 and 0 <= i < len(self.extents):
+            start, length = self.extents[i]
+            skip = first - self.extent_index[i]
+            take = min(count, length - skip)
+            result.append((start + skip, take))
+            first += take
+            count -= take
+            i += 1
+        return result
+
+    def claim(self, mode):
+        # open the file in mode unless it is open already, telling whether it
+        # was this call that opened it
+        with self.lock.writing():
+            if self.open_mode is not None:
+                return False
+            self.open_mode = mode
+            return True
 
     def open(self, mode):
-        if self.open_mode is not None:
+        if not self.claim(mode):
             return f"\nFile {self.name} is already open"
-        self.open_mode = mode
         return f"\nFile {self.name} succesfully opened in {mode} mode"
 
     def close(self):
@@ -32,432 +463,1293 @@ class File:
     def write(self, data):
         if self.open_mode is None or 'w' not in self.open_mode and 'a' not in self.open_mode:
             return f"\nFile {self.name} not open in write or append mode"
-        self.lock.acquire()
-        try:
-            self.content += data
-            self.size += len(data)
-            self.modified_at = datetime.datetime.now()
-        finally:
-            self.lock.release()
-            return f"\nSuccessfuly written to file {self.name}"
+        self.append(data)
+        return f"\nSuccessfuly written to file {self.name}"
+
+    def append(self, data):
+        # write without checking the open mode, for data already accepted by
+        # a write the page cache held back
+        with self.lock.writing():
+            self.accessed_at = time.time_ns()
+            self.data.append(data)
+            self.size = len(self.data)
+            self.modified_at = time.time_ns()
 
     def write_at(self, offset, data):
         if self.open_mode is None or 'w' not in self.open_mode and 'a' not in self.open_mode:
             return f"\nFile {self.name} not open in write or append mode"
-        self.lock.acquire()
+        self.lock.acquire_write()
         try:
-            if offset < 0 or offset > len(self.content):
+            self.accessed_at = time.time_ns()
+            if offset < 0 or offset > len(self.data):
                 return "Invalid offset"
-            self.content = self.content[:offset] + data + self.content[offset:]
-            self.size += len(data)
-            self.modified_at = datetime.datetime.now()
+            self.data.insert(offset, data)
+            self.size = len(self.data)
+            self.modified_at = time.time_ns()
         finally:
-            self.lock.release()
+            self.lock.release_write()
             return f"\nSuccessfuly written to file {self.name}"
 
     def read(self):
         if self.open_mode is not None and 'r' not in self.open_mode:
             return "File {self.name} not open in read mode"
-        self.lock.acquire()
+        self.lock.acquire_read()
         try:
-            return self.content
+            self.accessed_at = time.time_ns()
+            return str(self.readable)
         finally:
-            self.lock.release()
+            self.lock.release_read()
 
     def read_at(self, offset, length):
         if self.open_mode is not None and 'r' not in self.open_mode:
             return "File {self.name} not open in read mode"
-        self.lock.acquire()
+        self.lock.acquire_read()
         try:
-            if offset < 0 or offset > len(self.content):
+            self.accessed_at = time.time_ns()
+            if offset < 0 or offset > self.size:
                 return "Invalid offset"
-            return self.content[offset:offset+length]
+            return self.readable.read_at(offset, length)
         finally:
-            self.lock.release()
+            self.lock.release_read()
+
+    def read_stream(self, chunk_size=64 * 1024):
+        # a ContentStream over the file as it is now, which yields it in pieces
+        # of at most chunk_size without building one string of all of it
+        if self.open_mode is not None and 'r' not in self.open_mode:
+            return f"File {self.name} not open in read mode"
+        with self.lock.reading():
+            self.accessed_at = time.time_ns()
+            return self.readable.stream(chunk_size)
 
     def truncate(self, size=None):
         if self.open_mode is not None:
             return "File {self.name} is open"
         if size is None:
             size = 0
-        elif size < 0 or size > len(self.content):
+        elif size < 0 or size > len(self.data):
             return "Invalid size"
-        with self.lock:
-            self.content = self.content[:size]
+        with self.lock.writing():
+            self.accessed_at = time.time_ns()
+            self.data.truncate(size)
             self.size = size
-            self.modified_at = datetime.datetime.now()
+            self.modified_at = time.time_ns()
             return f"\nSuccessfuly truncated file {self.name}"
 
+    @property
+    def data(self):
+        if self._data is None or self.source is not None:
+            with File.load_lock:
+                if self.source is not None:
+                    source = self.source
+                    self._data = self.content_class.restore(source)
+                    self.source = None
+                    if source.cached:
+                        source.release()
+                elif self._data is None:
+                    self._data = self.content_class()
+        return self._data
+
+    @property
+    def readable(self):
+        # the content to read from: a compressed file is served from the
+        # decompression cache instead of being inflated for good
+        source = self.source
+        if source is not None and source.cached:
+            return source.content(self.content_class)
+        return self.data
+
+    def offload(self, source):
+        # drop the content in favour of source, which can bring it back
+        with File.load_lock:
+            self.source = source
+            self._data = None
+
+    def fill(self, content):
+        # hand a file without data a ready made content object
+        self._data = content
+        self.size = len(content)
+
+    @property
+    def content(self):
+        return str(self.readable)
+
+    def path(self):
+        return self.parent.path().rstrip('/') + '/' + self.name
+
     def __repr__(self):
         return f"File('{self.name}')"
 
 class Directory:
+    # slots, integer timestamps and a lazily created lock, as for File
+    MEMORY_BUDGET = 320
+    # guards creating the lock of directories that had none yet
+    lock_guard = threading.Lock()
+    __slots__ = ('name', 'parent', 'created_at', 'modified_at', 'contents', '_lock', 'deleted')
+
     def __init__(self, name, parent=None):
         self.name = name
         self.parent = parent
-        self.created_at = datetime.datetime.now()
+        self.created_at = time.time_ns()
         self.modified_at = self.created_at
         self.contents = {}
-        self.lock = threading.Lock()
+        # guards changes to contents; reentrant so VirtualFileSystem can hold it
+        # across a check and the add/remove that follows. Lookups don't take it.
+        self._lock = None
+        # set once the directory has been removed, so late creates fail
+        self.deleted = False
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            with Directory.lock_guard:
+                if self._lock is None:
+                    self._lock = threading.RLock()
+        return self._lock
+
+    @lock.setter
+    def lock(self, lock):
+        self._lock = lock
 
     def add_file(self, file):
         with self.lock:
+            file.parent = self
             self.contents[file.name] = file
-            self.modified_at = datetime.datetime.now()
+            self.modified_at = time.time_ns()
 
     def add_directory(self, directory):
         with self.lock:
             directory.parent = self
             self.contents[directory.name] = directory
-            self.modified_at = datetime.datetime.now()
+            self.modified_at = time.time_ns()
 
     def get_file(self, name):
-        with self.lock:
-            if name in self.contents and isinstance(self.contents[name], File):
-                return self.contents[name]
-            return None
+        item = self.contents.get(name)
+        if isinstance(item, File):
+            return item
+        return None
 
     def get_directory(self, name):
-        with self.lock:
-            if name in self.contents and isinstance(self.contents[name], Directory):
-                return self.contents[name]
-            return None
+        item = self.contents.get(name)
+        if isinstance(item, Directory):
+            return item
+        return None
 
     def remove_file(self, file):
         with self.lock:
             del self.contents[file.name]
-            self.modified_at = datetime.datetime.now()
+            self.modified_at = time.time_ns()
 
     def remove_directory(self, directory):
         with self.lock:
             del self.contents[directory.name]
-            self.modified_at = datetime.datetime.now()
+            self.modified_at = time.time_ns()
+
+    def path(self):
+        if self.parent is None:
+            return '/'
+        return self.parent.path().rstrip('/') + '/' + self.name
 
     def __repr__(self):
         return f"Directory('{self.name}')"
 
-class VirtualFileSystem:
+class BlockAllocator:
+    # Free space is tracked as extents (start, length), with a running count
+    # of free blocks so nothing has to scan the device. Extents are filed by
+    # start in buckets of 2**SHIFT blocks, each a sorted list of at most half
+    # that many starts since free extents are always coalesced, under a max
+    # segment tree of the longest extent starting in each bucket. First-fit
+    # walks the tree down to the first bucket with room and coalescing walks
+    # it to the nearest bucket holding an extent, both in O(log blocks) however
+    # fragmented the device is. Best-fit takes the first (length, start) pair
+    # not below (count, -1) from a SortedNames.
+    SHIFT = 6
+
+    def __init__(self, num_blocks, policy='first'):
+        if policy not in ('first', 'best'):
+            raise ValueError(f"Unknown allocation policy: {policy}")
+        self.num_blocks = num_blocks
+        self.policy = policy
+        self.free = 0
+        buckets = (num_blocks >> self.SHIFT) + 1
+        # bucket -> sorted starts of the extents in it, None while empty
+        self.buckets = [None] * buckets
+        self.size = 1 << (buckets - 1).bit_length()
+        # tree[size + b] is the longest extent starting in bucket b and
+        # tree[n] the longest below node n
+        self.tree = [0] * (2 * self.size)
+        self.lengths = {}
+        self.by_size = SortedNames()
+        self.lock = threading.Lock()
+        if num_blocks:
+            self._add(0, num_blocks)
+            self.free = num_blocks
+
+    def _update(self, b):
+        bucket = self.buckets[b]
+        tree = self.tree
+        node = self.size + b
+        tree[node] = max(map(self.lengths.__getitem__, bucket)) if bucket else 0
+        node >>= 1
+        while node:
+            longest = max(tree[2 * node], tree[2 * node + 1])
+            if tree[node] == longest:
+                # nothing above changes either
+                break
+            tree[node] = longest
+            node >>= 1
+
+    def _add(self, start, length):
+        b = start >> self.SHIFT
+        if self.buckets[b] is None:
+            self.buckets[b] = []
+        bisect.insort(self.buckets[b], start)
+        self.lengths[start] = length
+        self.by_size.add((length, start))
+        self._update(b)
+
+    def _remove(self, start):
+        length = self.lengths.pop(start)
+        b = start >> self.SHIFT
+        self.buckets[b].remove(start)
+        if not self.buckets[b]:
+            self.buckets[b] = None
+        self.by_size.remove((length, start))
+        self._update(b)
+        return length
+
+    def _before(self, start):
+        # start of the last free extent starting at or before start, or None
+        b = start >> self.SHIFT
+        bucket = self.buckets[b]
+        if bucket:
+            i = bisect.bisect_right(bucket, start)
+            if i:
+                return bucket[i - 1]
+        tree = self.tree
+        node = self.size + b
+        while node > 1:
+            if node & 1 and tree[node - 1]:
+                # the rightmost bucket holding an extent below the sibling
+                node -= 1
+                while node < self.size:
+                    node = 2 * node + 1 if tree[2 * node + 1] else 2 * node
+                return self.buckets[node - self.size][-1]
+            node >>= 1
+        return None
+
+    def _take(self, start, count):
+        # carve count blocks off the front of the free extent at start
+        length = self._remove(start)
+        if length > count:
+            self._add(start + count, length - count)
+        self.free -= count
+        return (start, count)
+
+    def _fit(self, count):
+        # start of a free extent holding at least count blocks, or None
+        if self.policy == 'best':
+            for length, start in self.by_size.from_name((count, -1)):
+                return start
+            return None
+        return self._first(count)
+
+    def _first(self, count):
+        # start of the first free extent holding at least count blocks
+        tree = self.tree
+        if tree[1] < count:
+            return None
+        node = 1
+        while node < self.size:
+            node *= 2
+            if tree[node] < count:
+                node += 1
+        for start in self.buckets[node - self.size]:
+            if self.lengths[start] >= count:
+                return start
+
+    def allocate(self, count):
+        # list of extents covering count blocks, a single one whenever a free
+        # extent is large enough, or None if the device can't hold them
+        with self.lock:
+            if count <= 0:
+                return []
+            if count > self.free:
+                return None
+            start = self._fit(count)
+            if start is not None:
+                return [self._take(start, count)]
+            extents = []
+            while count:
+                start = self._first(1)
+                extents.append(self._take(start, min(count, self.lengths[start])))
+                count -= extents[-1][1]
+            return extents
+
+    def claim(self, start, length):
+        # mark a specific free range as used, for restoring a saved layout
+        with self.lock:
+            first = self._before(min(start, self.num_blocks))
+            if first is None or first + self.lengths[first] < start + length:
+                raise ValueError(f"Blocks {start}-{start + length - 1} are not free")
+            extent = self._remove(first)
+            if start > first:
+                self._add(first, start - first)
+            if first + extent > start + length:
+                self._add(start + length, first + extent - start - length)
+            self.free -= length
+
+    def release(self, start, length):
+        with self.lock:
+            self.free += length
+            # coalesce with the free extents on either side
+            if start + length in self.lengths:
+                length += self._remove(start + length)
+            before = self._before(start)
+            if before is not None and before + self.lengths[before] == start:
+                length += self._remove(before)
+                start = before
+            self._add(start, length)
+
+class Session:
+    # per-client state: the working directory paths resolve against and the
+    # files this client has open
+    def __init__(self, vfs):
+        self.vfs = vfs
+        self.current_directory = vfs.root
+        self.open_files = {}
+
+    def close_all(self):
+        for file in self.open_files:
+            self.vfs.settle(file)
+            file.close()
+        self.open_files.clear()
+
+class PathCache:
+    # (start directory, path) -> Directory for paths resolved before; the
+    # start is None for absolute paths. Directories are never renamed and
+    # move_file only moves files, so the only thing that can invalidate an
+    # entry is the deletion of its directory (or, through it, of a directory
+    # on the way), and delete_directory flags every directory it removes.
+    # Lookups check that flag, so invalidation costs nothing up front. When
+    # full the least recently used entry makes room for the new one.
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(path):
+        # '..' after a named component could walk through a directory that is
+        # later deleted and still land somewhere alive, so those aren't kept
+        named = False
+        for component in path.split('/'):
+            if component == '..':
+                if named:
+                    return False
+            elif component not in ('', '.'):
+                named = True
+        return True
+
+    def get(self, key):
+        with self.lock:
+            directory = self.entries.get(key)
+            if directory is None or directory.deleted:
+                if directory is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return directory
+
+    def put(self, key, directory):
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+            self.entries[key] = directory
+            self.entries.move_to_end(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = self.hits / lookups if lookups else 0.0
+            return (f"\npath cache: {len(self.entries)} of {self.capacity} entries, {self.hits} hits, "
+                    f"{self.misses} misses, hit rate {rate:.1%}")
+
+class SortedNames:
+    # Distinct names in order, held as a list of sorted blocks of up to
+    # 2 * LOAD names plus the largest name of each block. Adding or removing a
+    # name shifts one block rather than every name after it, and only a block
+    # being split touches the list of blocks, so inserts stay cheap at tens of
+    # millions of names.
+    LOAD = 512
+
     def __init__(self):
-        self.root = Directory('root')
-        self.current_directory = self.root
+        self.blocks = []
+        self.maxes = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block
+
+    def add(self, name):
+        if not self.blocks:
+            self.blocks.append([name])
+            self.maxes.append(name)
+        else:
+            i = bisect.bisect_left(self.maxes, name)
+            if i == len(self.maxes):
+                # past every name so far, goes at the end of the last block
+                i -= 1
+                self.blocks[i].append(name)
+                self.maxes[i] = name
+            else:
+                bisect.insort(self.blocks[i], name)
+            block = self.blocks[i]
+            if len(block) > 2 * self.LOAD:
+                self.blocks[i:i+1] = [block[:self.LOAD], block[self.LOAD:]]
+                self.maxes[i:i+1] = [block[self.LOAD - 1], block[-1]]
+        self.length += 1
+
+    def remove(self, name):
+        i = bisect.bisect_left(self.maxes, name)
+        block = self.blocks[i]
+        del block[bisect.bisect_left(block, name)]
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+        self.length -= 1
+
+    def from_name(self, start):
+        # the names not below start, in order
+        i = bisect.bisect_left(self.maxes, start)
+        if i == len(self.blocks):
+            return
+        offset = bisect.bisect_left(self.blocks[i], start)
+        for i in range(i, len(self.blocks)):
+            yield from self.blocks[i][offset:]
+            offset = 0
+
+class NameIndex:
+    # Every file and directory below the root by name, with the distinct names
+    # also kept sorted, and every file by type. A name held by one entry maps
+    # straight to it, only shared names get a set. Entries are stored rather
+    # than their paths, so move_file needs no update and paths are only built
+    # for the matches a query returns.
+    def __init__(self):
+        self.names = {}
+        self.sorted_names = SortedNames()
+        self.types = {}
         self.lock = threading.Lock()
-        self.memory = [[{} for _ in range(8)] for _ in range(8)]
 
-    def create_file(self, name):
+    def add(self, item):
+        with self.lock:
+            held = self.names.get(item.name)
+            if held is None:
+                self.names[item.name] = item
+                self.sorted_names.add(item.name)
+            elif isinstance(held, set):
+                held.add(item)
+            else:
+                self.names[item.name] = {held, item}
+            if isinstance(item, File) and item.type:
+                self.types.setdefault(item.type, set()).add(item)
+
+    def remove(self, item):
         with self.lock:
+            held = self.names.get(item.name)
+            if held is item:
+                del self.names[item.name]
+                self.sorted_names.remove(item.name)
+            elif isinstance(held, set):
+                held.discard(item)
+                if len(held) == 1:
+                    self.names[item.name] = held.pop()
+            if isinstance(item, File) and item.type:
+                files = self.types.get(item.type)
+                if files is not None:
+                    files.discard(item)
+                    if not files:
+                        del self.types[item.type]
+
+    def add_tree(self, directory):
+        for item in directory.contents.values():
+            self.add(item)
+            if isinstance(item, Directory):
+                self.add_tree(item)
+
+    def _entries(self, name):
+        held = self.names.get(name)
+        if held is None:
+            return []
+        return list(held) if isinstance(held, set) else [held]
+
+    def find(self, pattern):
+        # entries whose name matches the glob pattern. A plain name is one
+        # lookup and a pattern whose only wildcard is a trailing '*' a range
+        # of the sorted names; anything else is matched against the distinct
+        # names, which is still independent of how deep the tree is
+        with self.lock:
+            stem = pattern.rstrip('*')
+            if not any(c in stem for c in '*?['):
+                if stem == pattern:
+                    return self._entries(pattern)
+                found = []
+                for name in self.sorted_names.from_name(stem):
+                    if not name.startswith(stem):
+                        break
+                    found.extend(self._entries(name))
+                return found
+            found = []
+            for name in fnmatch.filter(self.sorted_names, pattern):
+                found.extend(self._entries(name))
+            return found
+
+    def find_type(self, type):
+        with self.lock:
+            return list(self.types.get(type, ()))
+
+class VirtualFileSystem:
+    # cells per row in the memory map, also used for the block labels
+    MAP_WIDTH = 8
+
+    def __init__(self, num_blocks=64, policy='first', block_size=1):
+        self.root = Directory('root')
+        # session used by callers that don't pass their own
+        self.session = Session(self)
+        self.path_cache = PathCache()
+        self.index = NameIndex()
+        # optional VFMS_textindex.TextIndex narrowing down grep
+        self.text_index = None
+        # optional VFMS_dedup.Dedup sharing blocks with identical contents
+        self.dedup = None
+        # optional VFMS_compress.Compressor squeezing files that went cold
+        self.compressor = None
+        # optional VFMS_pagecache.PageCache holding pages and pending appends
+        self.page_cache = None
+        self.reset_device(num_blocks, policy, block_size)
+        # optional WriteAheadLog receiving every successful change
+        self.wal = None
+        # mapping of the snapshot lazily loaded files still read from
+        self.snapshot = None
+
+    @property
+    def current_directory(self):
+        return self.session.current_directory
+
+    @current_directory.setter
+    def current_directory(self, directory):
+        self.session.current_directory = directory
+
+    def new_session(self):
+        return Session(self)
+
+    def reset_device(self, num_blocks, policy='first', block_size=1):
+        self.block_size = block_size
+        self.allocator = BlockAllocator(num_blocks, policy)
+        if self.dedup is not None:
+            self.dedup.reset()
+        # one cell per block, (file, logical block, directory name) while in use
+        self.memory = [None] * num_blocks
+
+    def log(self, op, **fields):
+        if self.wal is not None:
+            self.wal.append(op, **fields)
+
+    def log_change(self, _file, op, **fields):
+        # log a change to _file unless it was deleted meanwhile; discard_file
+        # marks it deleted under its write lock before the delete is logged, so
+        # a record made under the read lock can't land after it
+        if self.wal is not None:
+            with _file.lock.reading():
+                if not _file.deleted:
+                    self.wal.append(op, path=_file.path(), **fields)
+
+    def log_many(self, records):
+        if self.wal is not None and records:
+            self.wal.append_many(records)
+
+    def index_entry(self, item):
+        self.index.add(item)
+        if self.text_index is not None and isinstance(item, File):
+            self.text_index.add(item)
+
+    def unindex_entry(self, item):
+        self.index.remove(item)
+        if self.text_index is not None and isinstance(item, File):
+            self.text_index.remove(item)
+        if self.page_cache is not None and isinstance(item, File):
+            self.page_cache.forget(item)
+
+    def files(self, directory):
+        # every file below directory
+        for item in list(directory.contents.values()):
+            if isinstance(item, File):
+                yield item
+            else:
+                yield from self.files(item)
+
+    # Locking: each operation takes the lock of the directory it changes, so
+    # work in disjoint directories runs in parallel. When two locks are needed
+    # a parent is always locked before its child, and move_file takes its two
+    # in order of lock_key, (depth, id()), a total order that keeps to that
+    # rule. A directory marked deleted refuses every further change.
+
+    def create_file(self, name, session=None):
+        cwd = (session or self.session).current_directory
+        with cwd.lock:
+            if cwd.deleted:
+                return f"\nNo such directory: {cwd.name}"
             file = File(name)
-            if file.name in self.current_directory.contents:
+            if file.name in cwd.contents:
                 return f"\n{name} already exists in current directory"
-            self.current_directory.add_file(file)
+            cwd.add_file(file)
+            self.index_entry(file)
+            self.log('create', path=file.path())
             return f"\nFile created: {name}"
 
-    def delete_file(self, name):
-        with self.lock:
-            file = self.current_directory.get_file(name)
+    def delete_file(self, name, session=None):
+        cwd = (session or self.session).current_directory
+        with cwd.lock:
+            if cwd.deleted:
+                return f"\nNo such directory: {cwd.name}"
+            file = cwd.get_file(name)
             if file:
-                self.current_directory.remove_file(file)
+                cwd.remove_file(file)
+                self.discard_file(file)
+                self.unindex_entry(file)
+                self.log('delete', path=file.path())
                 return f"\nFile deleted: {name}"
             else:
                 return f"\nNo such file: {name}"
 
-    def create_directory(self, name):
-        with self.lock:
+    def create_directory(self, name, session=None):
+        cwd = (session or self.session).current_directory
+        with cwd.lock:
+            if cwd.deleted:
+                return f"\nNo such directory: {cwd.name}"
             directory = Directory(name)
-            if directory.name in self.current_directory.contents:
+            if directory.name in cwd.contents:
                 return f"\n{name} already exists in current directory"
-            self.current_directory.add_directory(directory)
+            cwd.add_directory(directory)
+            self.index_entry(directory)
+            self.log('mkdir', path=directory.path())
             return f"\nDirectory created: {name}"
 
-    def delete_directory(self, name):
-        with self.lock:
-            directory = self.current_directory.get_directory(name)
+    def delete_directory(self, name, session=None):
+        cwd = (session or self.session).current_directory
+        with cwd.lock:
+            if cwd.deleted:
+                return f"\nNo such directory: {cwd.name}"
+            directory = cwd.get_directory(name)
             if directory:
-                self.current_directory.remove_directory(directory)
+                self.release_tree(directory)
+                cwd.remove_directory(directory)
+                self.log('rmdir', path=directory.path())
                 return f"\nDirectory deleted: {name}"
             else:
                 return f"\nNo such directory: {name}"
 
-    def change_directory(self, path):
+    def walk(self, path, start):
+        # directory reached by following path from start, or the name of the
+        # first component that doesn't exist
         if path == '/':
+            return self.root, None
+        path_components = path.split('/')
+        if path_components[0] == '':
+            # Absolute path, start at the root directory
             current_directory = self.root
+            path_components = path_components[1:]
         else:
-            path_components = path.split('/')
-            if path_components[0] == '':
-                # Absolute path, start at the root directory
-                current_directory = self.root
-                path_components = path_components[1:]
+            # Relative path, start at the given directory
+            current_directory = start
+        for component in path_components:
+            if component in ('', '.'):
+                continue
+            if component == '..':
+                # Move up one level in the directory structure, staying at root
+                current_directory = current_directory.parent or current_directory
             else:
-                # Relative path, start at the current directory
-                current_directory = self.current_directory
-            for component in path_components:
-                if component == '..':
-                    # Move up one level in the directory structure
-                    current_directory = current_directory.parent
+                # Move down one level in the directory structure
+                directory = current_directory.get_directory(component)
+                if directory:
+                    current_directory = directory
                 else:
-                    # Move down one level in the directory structure
-                    directory = current_directory.get_directory(component)
-                    if directory:
-                        current_directory = directory
-                    else:
-                        return f"\nNo such directory: {component}"
-        self.current_directory = current_directory
-        return f"\nSuccessfuly moved to directory: {str(self.current_directory.name)}"
+                    return None, component
+        return current_directory, None
 
-    def move_file(self, file_name, path):
-        called_directory = self.current_directory
-        with self.lock:
+    def resolve(self, path, session=None):
+        # walk() from the session's directory, answered from the path cache
+        # when possible; returns (directory, missing component)
+        start = (session or self.session).current_directory
+        key = (None if path.startswith('/') else start, path)
+        directory = self.path_cache.get(key)
+        if directory is not None:
+            return directory, None
+        directory, missing = self.walk(path, start)
+        if directory is not None and PathCache.cacheable(path):
+            self.path_cache.put(key, directory)
+        return directory, missing
+
+    def change_directory(self, path, session=None):
+        session = session or self.session
+        directory, missing = self.resolve(path, session)
+        if directory is None:
+            return f"\nNo such directory: {missing}"
+        session.current_directory = directory
+        return f"\nSuccessfuly moved to directory: {str(directory.name)}"
+
+    @staticmethod
+    def lock_key(directory):
+        # (depth, id()): a total order over directories that still puts every
+        # ancestor before its descendants; directories never move, so a
+        # directory's key never changes
+        depth = 0
+        node = directory.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth, id(directory)
+
+    def lock_order(self, a, b):
+        return sorted((a, b), key=self.lock_key)
+
+    def move_file(self, file_name, path, session=None):
+        called_directory = (session or self.session).current_directory
+        target, missing = self.resolve(path, session)
+        if target is None:
+            return f"\nNo such directory: {missing}"
+        first, second = self.lock_order(called_directory, target)
+        with first.lock, second.lock:
+            for directory in (called_directory, target):
+                if directory.deleted:
+                    return f"\nNo such directory: {directory.name}"
             # Get the file to be moved
-            file_to_move = self.current_directory.get_file(file_name)
+            file_to_move = called_directory.get_file(file_name)
             if not file_to_move:
                 return f"\nNo such file: {file_name}"
-            self.change_directory(path)
+            if target is not called_directory and file_name in target.contents:
+                return f"\n{file_name} already exists in {target.name}"
+            source = file_to_move.path()
             # Remove the file from its current directory
             called_directory.remove_file(file_to_move)
             # Add the file to the target directory
-            self.current_directory.add_file(file_to_move)
-            self.current_directory = called_directory
+            target.add_file(file_to_move)
+            self.log('move', path=source, target=target.path())
             return f"\n{file_name} has been moved to {path}"
 
-    def calc_free_memory(self):
-        count = 0
-        for i in self.memory:
-            for j in i:
-                if j == {}:
-                    count+=1
-        return count
-            
-        
-    def update_mmap(self, _file):
-        ind = 0
-        s = _file.read()
-        for i in self.memory:
-            while {} in i:
-                if ind == len(s):
-                    return
-                for j in i:
-                    if j == {}:
-                        j.update({s[ind] : self.current_directory.name+", "+_file.name+", "+"block "+str(self.memory.index(i)+1)})
-                        ind+=1
-                        break
-                    else:
-                        continue
+    def grep(self, text, path=None, session=None):
+        # files below path (default the working directory) containing text,
+        # or an error message; with a text index only its candidates and the
+        # files it doesn't cover are read
+        if path is None:
+            scope = (session or self.session).current_directory
+        else:
+            scope, missing = self.resolve(path, session)
+            if scope is None:
+                return f"\nNo such directory: {missing}"
+        self.settle()
+        index = self.text_index
+        needle = File.content_class.coerce(text)
+        candidates = index.candidates(needle) if index is not None else None
+        if candidates is None:
+            files = self.files(scope)
+        else:
+            with index.lock:
+                files = candidates | index.unindexed
+            files = [f for f in files if self.within(f, scope)]
+        found = []
+        for _file in files:
+            if _file.deleted:
                 continue
+            if needle in _file.readable.native():
+                found.append(_file)
+            if index is not None and _file in index.unindexed:
+                index.index_unindexed(_file)
+        return found
 
-# main interactive loop
-def terminal():
-    try:
-        with open("VFMS.json") as jf:
-            temp = json.load(jf)
-            vfs = jsonpickle.decode(temp)
-    except:
-        vfs = VirtualFileSystem()
-    t_no = threads.index(t)+1
-    with open(f"input_thread{t_no}.txt", "r") as fin:
-        lines = []
-        for line in fin:
-            line = line.strip()
-            lines.append(line)
-    fout = ''
-    with patch('builtins.input') as input_mock:
-        input_mock.side_effect = lines
-    
-        while True:
-            command = input(f"{vfs.current_directory.name}$ ")
-            parts = command.split()
+    @staticmethod
+    def within(item, directory):
+        node = item.parent
+        while node is not None:
+            if node is directory:
+                return True
+            node = node.parent
+        return False
 
-            # ignore no command
-            if not parts:
-                continue
+    def open_file(self, name, mode, session=None):
+        session = session or self.session
+        file = session.current_directory.get_file(name)
+        if not file:
+            return f"\nNo such file: {name}"
+        # only the session that opened the file closes it when it ends
+        if not file.claim(mode):
+            return f"\nFile {name} is already open"
+        session.open_files[file] = mode
+        return f"\nFile {name} succesfully opened in {mode} mode"
 
-            # list the details of current directory
-            if parts[0] == "ls":
-                fout+=(f"\n{'name':15} {'type':10} {'size':10} {'mode':10} {'last_modified':19}")
-                for item in vfs.current_directory.contents.values():
-                    if str(item)[:4] == "File":
-                        fout+=(f"\n{str(item.name):15} {str(item.type):10} {str(item.size)+'B':10} {str(item.open_mode):10} {str(item.modified_at)[:19]}")
-                    else:
-                        fout+=(f"\n{str(item.name):15} {'dir':10} {'-':10} {'-':10} {str(item.modified_at)[:19]}")
-
-            # create file
-            elif parts[0] == "create":
-                if len(parts) != 2:
-                    fout+=("Usage: create <name>")
-                    continue
-                fout+=(vfs.create_file(parts[1]))
-
-            # delete file
-            elif parts[0] == "delete":
-                if len(parts) != 2:
-                    fout+=("Usage: delete <name>")
-                    continue
-                fout+=(vfs.delete_file(parts[1]))
-
-            # make directory
-            elif parts[0] == "mkdir":
-                if len(parts) != 2:
-                    fout+=("Usage: mkdir <name>")
-                    continue
-                fout+=(vfs.create_directory(parts[1]))
-
-            # delete directory
-            elif parts[0] == "rmdir":
-                if len(parts) != 2:
-                    fout+=("Usage: rmdir <name>")
-                    continue
-                fout+=(vfs.delete_directory(parts[1]))
-
-            # change directory
-            elif parts[0] == "chdir":
-                if len(parts) != 2:
-                    fout+=("Usage: chdir <path>")
-                    continue
-                fout+=(vfs.change_directory(parts[1]))
-
-            # move file to target directory
-            elif parts[0] == "move":
-                if len(parts) != 3:
-                    fout+=("Usage: move <f_name> <path>")
-                    continue
-                fout+=(vfs.move_file(parts[1], parts[2]))
-
-            # open file
-            elif parts[0] == "open":
-                if len(parts) != 3:
-                    fout+=("Usage: open <name> <mode>")
-                    continue
-                file = vfs.current_directory.get_file(parts[1])
-                if file:
-                    if parts[2] == "w":
-                        fout+=(file.open("w"))
-                    elif parts[2] == "r":
-                        fout+=(file.open("r"))
-                    else:
-                        fout+=("Enter a valid mode to open file (r,w)")
-                else:
-                    fout+=(f"\nNo such file: {parts[1]}")
-                    
-            # close file
-            elif parts[0] == "close":
-                if len(parts) != 2:
-                    fout+=("Usage: close <name>")
-                    continue
-                file = vfs.current_directory.get_file(parts[1])
-                if file:
-                    fout+=(file.close())
-                else:
-                    fout+=(f"\nNo such file: {parts[1]}")
-
-            # write to file
-            elif parts[0] == "write_to_file":
-                if len(parts) !=3 and len(parts) != 4:
-                    fout+=("Usage: write_to_file <name> <data> <offset>")
-                    continue
-                if vfs.calc_free_memory() < len(parts[2]):
-                    fout+=("Cannot write to file as memory is full")
-                    continue
-                file = vfs.current_directory.get_file(parts[1])
-                if file:
-                    if len(parts) == 3:
-                        fout+=(file.write(parts[2]))
-                        file.close()
-                        file.open("r")
-                        vfs.update_mmap(file)
-                        file.close()
-                        file.open("w")
-                    elif len(parts) == 4:
-                        offset = int(parts[3])
-                        fout+=(file.write_at(offset, parts[2]))
-                else:
-                    fout+=(f"\nNo such file: {parts[1]}")
-
-            # read from file
-            elif parts[0] == "read_from_file":
-                if len(parts) != 2 and len(parts) != 4:
-                    fout+=("Usage: read_from_file <name> <offset> <length>")
-                    continue
-                file = vfs.current_directory.get_file(parts[1])
-                if file:
-                    if len(parts) == 2:
-                        fout+=(file.read())
-                    elif len(parts) == 4:
-                        offset = int(parts[2])
-                        length = int(parts[3])
-                        fout+=(file.read_at(offset, length))
-                else:
-                    fout+=(f"\nNo such file: {parts[1]}")
-
-            # truncate file
-            elif parts[0] == "truncate":
-                if len(parts) != 2 and len(parts) != 3:
-                    fout+=("Usage: truncate <name> <size>")
-                    continue
-                file = vfs.current_directory.get_file(parts[1])
-                if file:
-                    size = int(parts[2]) if len(parts) == 3 else 0
-                    fout+=(file.truncate(size))
+    def close_file(self, name, session=None):
+        session = session or self.session
+        file = session.current_directory.get_file(name)
+        if not file:
+            return f"\nNo such file: {name}"
+        session.open_files.pop(file, None)
+        self.settle(file)
+        return file.close()
+
+    def calc_free_memory(self):
+        if self.page_cache is not None:
+            return self.allocator.free - self.page_cache.pending_blocks()
+        return self.allocator.free
+
+    def blocks_needed(self, size):
+        return -(-size // self.block_size)
+
+    def release_blocks(self, _file, count):
+        if self.dedup is not None:
+            self.dedup.drop(self, _file, _file.blocks - count)
+            return
+        for start, length in _file.drop_blocks(count):
+            for block in range(start, start + length):
+                self.memory[block] = None
+            self.allocator.release(start, length)
+
+    def discard_file(self, _file):
+        # a deleted file gives back all its blocks and never maps new ones
+        with _file.lock.writing():
+            _file.deleted = True
+            self.release_blocks(_file, _file.blocks)
+
+    def release_tree(self, directory):
+        # once marked deleted under its lock nothing else changes a directory,
+        # so its contents are released without keeping the lock
+        with directory.lock:
+            directory.deleted = True
+            items = list(directory.contents.values())
+        self.unindex_entry(directory)
+        for item in items:
+            if isinstance(item, File):
+                self.discard_file(item)
+                self.unindex_entry(item)
+            else:
+                self.release_tree(item)
+
+    def truncate_file(self, _file, size=None):
+        self.settle(_file)
+        before = _file.size
+        if self.text_index is None:
+            result = _file.truncate(size)
+        else:
+            result = self.text_index.truncate(_file, size, lambda: _file.truncate(size))
+        first = None
+        if _file.size != before:
+            first = _file.size // self.block_size
+            self.log_change(_file, 'truncate', size=_file.size)
+            if self.page_cache is not None:
+                self.page_cache.invalidate(_file, _file.size)
+        self.update_mmap(_file, first)
+        return result
+
+    def read_at(self, _file, offset, length):
+        if self.page_cache is not None:
+            return self.page_cache.read_at(_file, offset, length)
+        return _file.read_at(offset, length)
+
+    def settle(self, _file=None):
+        # flush appends the page cache holds back for _file, or for every file
+        if self.page_cache is not None:
+            if _file is None:
+                return self.page_cache.sync()
+            return self.page_cache.flush(_file)
+        return 0
+
+    def size_of(self, _file):
+        # the file's size counting appends the page cache holds back, which
+        # leaves them unflushed
+        if self.page_cache is not None:
+            return _file.size + self.page_cache.pending_size(_file)
+        return _file.size
+
+    def sync(self):
+        # push every pending change to the log and the log to disk, returning
+        # how many dirty pages were flushed
+        pages = self.settle()
+        if self.wal is not None:
+            self.wal.flush()
+        return pages
+
+    def map_cell(self, block):
+        if self.memory[block] is None:
+            return None
+        _file, index, dir_name = self.memory[block]
+        label = dir_name+", "+_file.name+", "+"block "+str(block // self.MAP_WIDTH + 1)
+        return {_file.readable.text_at(index * self.block_size, self.block_size) : label}
+
+    def map_files(self, files, dir_name):
+        # blocks for files not in the tree yet, taken with one allocation and
+        # handed out in order
+        if self.dedup is not None:
+            for _file in files:
+                self.dedup.remap(self, _file, 0, dir_name)
+            return
+        needed = [self.blocks_needed(_file.size) for _file in files]
+        extents = collections.deque(self.allocator.allocate(min(sum(needed), self.allocator.free)) or ())
+        for _file, count in zip(files, needed):
+            while count and extents:
+                start, length = extents[0]
+                take = min(count, length)
+                for block in range(start, start + take):
+                    self.memory[block] = (_file, _file.blocks + block - start, dir_name)
+                _file.add_extents([(start, take)])
+                if take == length:
+                    extents.popleft()
                 else:
-                    fout+=(f"\nNo such file: {parts[1]}")
-
-            # display memory map
-            elif parts[0] == "show_memory_map":
-                fout+=("\n\n")
-                count = 0
-                for i in vfs.memory:
-                    for j in i:
-                        if j == {}:
-                            fout+=("*\t")
-                        else:
-                            fout+=(str(j)+"\t")
-                        count += 1
-                        if count % 8 == 0:
-                            fout+=("\n")
-                continue
+                    extents[0] = (start + take, length - take)
+                count -= take
 
+    def import_host(self, host_dir, path, session=None):
+        target, missing = self.resolve(path, session)
+        if target is None:
+            return f"\nNo such directory: {missing}"
+        return VFMS_host.import_tree(self, host_dir, target, File, Directory)
 
-            elif parts[0] == "help":
-                fout+=("Available commands:")
-                fout+=("  ls                                         List contents of current directory")
-                fout+=("  mkdir <name>                               Create new directory in current directory")
-                fout+=("  rmdir <name>                               Remove directory from current directory")
-                fout+=("  chdir <path>                               Change current directory. Set path as:")
-                fout+=("                                             ..      ==>     Move up directory")
-                fout+=("                                             /       ==>     Return to root")
-                fout+=("                                             /d/d    ==>     Absolute path")
-                fout+=("                                             d/d     ==>     Relative path")
-                fout+=("  create <name>                              Create new file in current directory")
-                fout+=("  delete <name>                              Remove file from current directory")
-                fout+=("  open <name> <mode>                         Open file in r or w mode")
-                fout+=("  close <name>                               Close file")
-                fout+=("  write_to_file <name> <data> <offset>       Write to file at a specific offset (optional)")
-                fout+=("  read_from_file <name> <offset> <length>    Read from file from a specific offset (optional)")
-                fout+=("  truncate <name> <size>                     Truncate file to a specified size (or all of it if not specified)")
-                fout+=("  show_memory_map                            Display Memory Map")
-                fout+=("  help                                       Display this help message")
-                fout+=("  exit                                       Exit the program")
-
-            elif parts[0] == "exit":
-                with open(f"output_thread{t_no}.txt", "w") as f:
-                    f.write(fout)
-                temp = jsonpickle.encode(vfs, unpicklable=False)
-                with open("VFMS.json","w") as f:
-                    json.dump(temp,f)
-                break
+    def export_host(self, path, host_dir, session=None):
+        source, missing = self.resolve(path, session)
+        if source is None:
+            return f"\nNo such directory: {missing}"
+        return VFMS_host.export_tree(source, host_dir)
+
+    def claim_blocks(self, _file, start, count, dir_name):
+        # give _file the blocks start .. start+count-1 as its next logical blocks
+        if self.dedup is not None:
+            return self.dedup.claim(self, _file, start, count, dir_name)
+        self.allocator.claim(start, count)
+        for block in range(start, start + count):
+            self.memory[block] = (_file, _file.blocks + block - start, dir_name)
+        _file.add_extents([(start, count)])
+
+    def save_snapshot(self, path, lsn=0):
+        self.settle()
+        VFMS_snapshot.save(self, path, lsn)
 
+    def load_snapshot(self, path):
+        lsn = VFMS_snapshot.load(self, path, File, Directory)
+        self.index = NameIndex()
+        self.index.add_tree(self.root)
+        if self.text_index is not None:
+            self.text_index.reset(self.files(self.root))
+        self.path_cache.clear()
+        return lsn
+
+    def write_to_file(self, _file, data, offset=None):
+        if offset is None:
+            if self.page_cache is not None:
+                return self.page_cache.write(_file, data)
+            apply = lambda: _file.write(data)
+        else:
+            self.settle(_file)
+            apply = lambda: _file.write_at(offset, data)
+        return self.apply_write(_file, data, offset, apply)
+
+    def apply_write(self, _file, data, offset, apply):
+        # run apply, which writes data to _file at offset (None to append),
+        # and bring the indexes, the log and the blocks in line with it
+        before = _file.size
+        if self.text_index is None:
+            result = apply()
+        else:
+            result = self.text_index.write(_file, offset, data, apply)
+        first = None
+        if _file.size != before:
+            first = (before if offset is None else offset) // self.block_size
+            if offset is None:
+                self.log_change(_file, 'write', data=data)
             else:
-                fout+=(f"\nUnknown command: {parts[0]}")
+                self.log_change(_file, 'write_at', data=data, offset=offset)
+            if self.page_cache is not None:
+                self.page_cache.invalidate(_file, before if offset is None else offset)
+        self.update_mmap(_file, first)
+        return result
+
+    def update_mmap(self, _file, first=None):
+        # bring the file's blocks in line with its size, mapping or releasing
+        # only the difference since it was last updated; with dedup the blocks
+        # from logical block first on, where the content changed, are remapped
+        with _file.lock.writing():
+            if _file.deleted:
+                return
+            if self.dedup is not None:
+                self.dedup.remap(self, _file, _file.blocks if first is None else first, _file.parent.name)
+                return
+            needed = self.blocks_needed(_file.size) - _file.blocks
+            if needed < 0:
+                self.release_blocks(_file, -needed)
+                return
+            extents = self.allocator.allocate(min(needed, self.allocator.free))
+            if not extents:
+                return
+            index = _file.blocks
+            for start, length in extents:
+                for block in range(start, start + length):
+                    self.memory[block] = (_file, index, _file.parent.name)
+                    index += 1
+            _file.add_extents(extents)
+
+class OutputWriter:
+    # Streams a session transcript to a file through a buffer instead of
+    # building it up in memory until exit. Flush policies:
+    #   command   after every command
+    #   bytes     once flush_bytes characters are buffered
+    #   interval  at the end of a command once flush_interval seconds passed
+    #   exit      only when closed, keeping everything buffered until then
+    # With ring_size set the last ring_size outputs are also kept in memory
+    # and handed back by recent_output().
+    def __init__(self, path, policy='bytes', flush_bytes=64 * 1024, flush_interval=1.0, ring_size=0):
+        if policy not in ('command', 'bytes', 'interval', 'exit'):
+            raise ValueError(f"Unknown flush policy: {policy}")
+        self.policy = policy
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        self.recent = collections.deque(maxlen=ring_size) if ring_size else None
+        self.file = open(path, "w")
+
+    def write(self, text):
+        if not text:
+            return
+        if not isinstance(text, str):
+            # a ContentStream goes straight to the file, piece by piece
+            self.flush()
+            for piece in text.text():
+                self.file.write(piece)
+            return
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.recent is not None:
+            self.recent.append(text)
+        if self.policy == 'bytes' and self.buffered >= self.flush_bytes:
+            self.flush()
+
+    def recent_output(self):
+        return ''.join(self.recent) if self.recent is not None else ''
+
+    def end_command(self):
+        if self.policy == 'command':
+            self.flush()
+        elif self.policy == 'interval' and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer.clear()
+            self.buffered = 0
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# how session scripts flush output_thread#.txt, see OutputWriter
+OUTPUT_POLICY = 'bytes'
+# outputs each session keeps in memory, 0 for none; a session whose command
+# raises prints them to stderr with the error
+OUTPUT_RING = 0
+# collect VFMS_stats counters and dump them to VFMS_stats.json at exit
+STATS = False
+# size cap in bytes of the trigram index behind grep, 0 to go without one
+TEXT_INDEX_BYTES = 0
+# 'str' keeps file contents as text, 'bytes' as utf-8 with memoryview reads
+# (see ByteContent)
+STORAGE = 'str'
+# share blocks with identical contents between files, see VFMS_dedup
+DEDUP = False
+# compress files idle for this many seconds, 0 to never compress, with this
+# codec, keeping up to COMPRESS_CACHE_BYTES of them decompressed for reads
+COMPRESS_IDLE = 0
+COMPRESS_CODEC = 'zlib'
+COMPRESS_CACHE_BYTES = 16 * 1024 * 1024
+# pages of PAGE_SIZE units kept by the page cache, 0 to go without one, and
+# the policy choosing which go when it is full (lru, clock or 2q)
+PAGE_CACHE_PAGES = 0
+PAGE_CACHE_POLICY = 'lru'
+PAGE_SIZE = 4096
+
+class ScriptJob:
+    # one session working through a parsed script, a command at a time
+    def __init__(self, vfs, name, script, output_path, weight=1):
+        self.vfs = vfs
+        self.name = name
+        self.script = script
+        self.position = 0
+        self.session = vfs.new_session()
+        self.output_path = output_path
+        self.fout = None
+        # commands run per turn, so a heavier session gets a bigger share
+        self.weight = weight
+        self.commands = 0
+        self.queue_time = 0.0
+        self.run_time = 0.0
+        self.ready_since = None
+
+    def writer(self):
+        if self.fout is None:
+            self.fout = OutputWriter(self.output_path, OUTPUT_POLICY, ring_size=OUTPUT_RING)
+        return self.fout
+
+    def step(self, count):
+        # run up to count commands, returning False once the script is over
+        self.writer()
+        for _ in range(count):
+            if self.position >= len(self.script):
+                return False
+            invocation = self.script[self.position]
+            self.position += 1
+            self.commands += 1
+            self.fout.write(VFMS_commands.execute(self.vfs, self.session, invocation))
+            if invocation[0] is not None and invocation[0].ends_session:
+                return False
+            self.fout.end_command()
+        return self.position < len(self.script)
+
+    def fail(self, error):
+        # a command raised: note it in the output and close what the session
+        # had open, as exit would; the rest of the script is dropped
+        recent = self.writer().recent_output()
+        if recent:
+            print(f"{self.name} failed with {type(error).__name__}: {error} after:{recent}", file=sys.stderr)
+        self.fout.write(VFMS_commands.internal_error(error))
+        self.session.close_all()
+
+    def finish(self):
+        # whatever the script got through is kept even without an exit
+        if self.fout is not None:
+            self.fout.close()
+        if self.vfs.wal is not None:
+            self.vfs.wal.flush()
+
+class Scheduler:
+    # Runs any number of ScriptJobs on a fixed pool of worker threads. Jobs
+    # wait in one ready queue and a worker runs weight commands of the job at
+    # its head before sending it to the back, so sessions interleave at command
+    # granularity and a long script can't hold a worker while short ones wait.
+    # Each job records how long it spent waiting in the queue and running.
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.ready = collections.deque()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.jobs = []
+
+    def submit(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            self.active += 1
+            job.ready_since = time.perf_counter()
+            self.ready.append(job)
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.ready and self.active:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+                job = self.ready.popleft()
+            started = time.perf_counter()
+            job.queue_time += started - job.ready_since
+            more = False
+            try:
+                more = job.step(job.weight)
+            except Exception as error:
+                # only the job ends, the worker goes on with the others
+                job.fail(error)
+            finally:
+                now = time.perf_counter()
+                job.run_time += now - started
+                if not more:
+                    job.finish()
+                with self.condition:
+                    if more:
+                        job.ready_since = now
+                        self.ready.append(job)
+                    else:
+                        self.active -= 1
+                    self.condition.notify_all()
+
+    def run(self):
+        # work through every submitted job, then return them with their stats
+        pool = [threading.Thread(target=self.work) for _ in range(self.workers)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        return self.jobs
+
+    def stats(self):
+        lines = [f"{'session':15} {'commands':>8} {'queued(ms)':>11} {'run(ms)':>9}"]
+        for job in self.jobs:
+            lines.append(f"{job.name:15} {job.commands:>8} {job.queue_time * 1000:>11.2f} {job.run_time * 1000:>9.2f}")
+        return '\n'.join(lines)
+
+def script_job(vfs, t_no):
+    # ScriptJob for input_thread{t_no}.txt writing to output_thread{t_no}.txt
+    with open(f"input_thread{t_no}.txt", "r") as fin:
+        script = VFMS_commands.parse_script(fin)
+    return ScriptJob(vfs, f"thread{t_no}", script, f"output_thread{t_no}.txt")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python program_name.py <number_of_threads>")
+        print("Usage: python program_name.py <number_of_threads> [workers]")
         sys.exit(1)
     k = int(sys.argv[1])
-    threads = []
+    # any number of scripts share a fixed pool of workers
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else min(k, 4)
+    if STATS:
+        VFMS_stats.install(globals())
+    if STORAGE == 'bytes':
+        File.content_class = ByteContent
+    # all sessions share one file system, restored from the last checkpoint plus
+    # whatever the operation log recorded after it
+    vfs = VirtualFileSystem()
+    if TEXT_INDEX_BYTES:
+        vfs.text_index = TextIndex(TEXT_INDEX_BYTES)
+    if DEDUP:
+        vfs.dedup = Dedup()
+    if PAGE_CACHE_PAGES:
+        vfs.page_cache = PageCache(vfs, PAGE_CACHE_PAGES, PAGE_CACHE_POLICY, PAGE_SIZE)
+    lsn = recover(vfs, "VFMS.ckpt", "VFMS.log")
+    vfs.wal = WriteAheadLog("VFMS.log", lsn=lsn)
+    if COMPRESS_IDLE:
+        vfs.compressor = Compressor(vfs, COMPRESS_IDLE, COMPRESS_CODEC, COMPRESS_CACHE_BYTES)
+        vfs.compressor.start()
+    scheduler = Scheduler(workers)
     for i in range(k):
-        t = threading.Thread(target=terminal)
-        threads.append(t)	
-        t.start()
-    # Wait for all threads to complete
-    for t in threads:
-        t.join()
-
-    # Program will close and exit after all threads are completed
\ No newline at end of file
+        scheduler.submit(script_job(vfs, i + 1))
+    scheduler.run()
+    if vfs.compressor is not None:
+        vfs.compressor.stop()
+    # fold the log into a fresh checkpoint now that nothing is running
+    checkpoint(vfs, "VFMS.ckpt", vfs.wal)
+    vfs.wal.close()
+    print(scheduler.stats())
+    if STATS:
+        VFMS_stats.dump("VFMS_stats.json")
+
+    # Program will close and exit after all sessions are completed
\ No newline at end of file
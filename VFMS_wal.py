@@ -0,0 +1,171 @@
+import os
+import json
+import base64
+import time
+import threading
+
+# Append-only operation log for the virtual file system. Every change made
+# through VirtualFileSystem is written as one JSON record per line, tagged with
+# a log sequence number (lsn), so persistence costs the size of the change
+# rather than the size of the whole tree. A checkpoint compacts the tree into a
+# binary snapshot (see VFMS_snapshot) that remembers the last lsn it covers, so
+# records already folded into it are skipped on replay. Data that is bytes
+# (byte storage) is logged as text when it is utf-8 and as base64 otherwise,
+# flagged with 'encoding', so binary content comes back from the log intact.
+
+class WriteAheadLog:
+    # sync policies:
+    #   always  fsync after every record
+    #   batch   group commit, fsync once batch_size records or batch_interval
+    #           seconds have accumulated since the last fsync
+    #   none    leave flushing to disk up to the OS
+    def __init__(self, path, sync='batch', batch_size=32, batch_interval=0.1, lsn=0):
+        if sync not in ('always', 'batch', 'none'):
+            raise ValueError(f"Unknown sync policy: {sync}")
+        self.path = path
+        self.sync = sync
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.lsn = lsn
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def append(self, op, **fields):
+        return self.append_many([(op, fields)])
+
+    def append_many(self, records):
+        # write (op, fields) records as one group, synced as a single record
+        # would be, and return the lsn of the last one
+        with self.lock:
+            for op, fields in records:
+                self.lsn += 1
+                if isinstance(fields.get('data'), bytes):
+                    encode_data(fields)
+                fields.update(lsn=self.lsn, op=op)
+                self.file.write(json.dumps(fields, separators=(',', ':')) + '\n')
+            # always hand the records to the OS so a crashed process keeps them
+            self.file.flush()
+            self.pending += len(records)
+            if self.sync == 'always':
+                self._fsync()
+            elif self.sync == 'batch':
+                if self.pending >= self.batch_size or time.monotonic() - self.last_sync >= self.batch_interval:
+                    self._fsync()
+            return self.lsn
+
+    def _fsync(self):
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            if self.pending and self.sync != 'none':
+                self._fsync()
+
+    def reset(self):
+        # drop every record, used once a checkpoint has absorbed them
+        with self.lock:
+            self.file.close()
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self._fsync()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+
+def encode_data(fields):
+    data = fields['data']
+    try:
+        fields['data'] = data.decode('utf-8')
+    except UnicodeDecodeError:
+        fields['data'] = base64.b64encode(data).decode('ascii')
+        fields['encoding'] = 'base64'
+
+
+def decode_data(record, content_class):
+    # a record's data as content_class stores it; binary data replayed into
+    # text storage is decoded the way importing it would have been
+    data = record['data']
+    if record.get('encoding') == 'base64':
+        data = base64.b64decode(data)
+        if not isinstance(content_class.EMPTY, bytes):
+            data = data.decode('utf-8', 'replace')
+    return data
+
+
+def read_records(path):
+    # records in a log file; a torn final line left by a crash mid-write is
+    # ignored
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+    except FileNotFoundError:
+        return
+
+
+def apply(vfs, record):
+    # redo one logged operation through the normal VirtualFileSystem API
+    op = record['op']
+    parent, _, name = record['path'].rpartition('/')
+    session = vfs.new_session()
+    directory, _ = vfs.resolve(parent or '/', session)
+    if directory is None:
+        # not something a consistent log holds; replaying it anywhere else
+        # could change an unrelated entry
+        return
+    session.current_directory = directory
+    if op == 'create':
+        vfs.create_file(name, session)
+    elif op == 'delete':
+        vfs.delete_file(name, session)
+    elif op == 'mkdir':
+        vfs.create_directory(name, session)
+    elif op == 'rmdir':
+        vfs.delete_directory(name, session)
+    elif op == 'move':
+        vfs.move_file(name, record['target'], session)
+    else:
+        _file = session.current_directory.get_file(name)
+        if _file is None:
+            return
+        if op == 'truncate':
+            vfs.truncate_file(_file, record['size'])
+        else:
+            _file.open('w')
+            vfs.write_to_file(_file, decode_data(record, _file.content_class), record.get('offset'))
+            vfs.settle(_file)
+            _file.close()
+
+
+def recover(vfs, checkpoint_path, log_path):
+    # rebuild vfs from the checkpoint and the log, returning the last lsn seen
+    wal, vfs.wal = vfs.wal, None
+    last = vfs.load_snapshot(checkpoint_path)
+    try:
+        for record in read_records(log_path):
+            # records up to the checkpoint's lsn are already part of it
+            if record['lsn'] > last:
+                apply(vfs, record)
+                last = record['lsn']
+    finally:
+        vfs.wal = wal
+    return last
+
+
+def checkpoint(vfs, checkpoint_path, wal):
+    # snapshot the current tree into checkpoint_path and empty the log; must
+    # run while no session is changing the tree; appends the page cache still
+    # holds are logged first, so the snapshot's lsn covers them
+    vfs.settle()
+    vfs.save_snapshot(checkpoint_path, wal.lsn)
+    wal.reset()